@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+"""Benchmarks for the networking code.
+
+Run ``python benchmark.py`` to run every benchmark, or pass benchmark names to only run those.
+"""
+
+import importlib.util
+import json
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+import random
+
+import anyio
+
+import channel
+import codec
+import metrics
+import mmsg
+import players
+import prediction
+from client import _Connection
+import snapshot
+import spatial
+from server import _Server
+
+from settings import *
+
+
+class _NullSocket:
+    """Stands in for a server socket, throwing away everything sent through it."""
+    async def sendto(self, data: bytes, host: str, port: int):
+        pass
+
+
+def make_game_state(player_count: int) -> dict:
+    """Create a game state with the given number of players spread over the screen."""
+    game_state = {"event": Event.UPDATE, "player_dicts": {}}
+    for player_id in range(player_count):
+        position = (player_id * 37 % SCREEN_SIZE[0], player_id * 53 % SCREEN_SIZE[1])
+        game_state["player_dicts"][player_id] = {"name": f"Player {player_id}", "position": position}
+    return game_state
+
+
+def bench_broadcast():
+    """Measure the cost of encoding one tick of game state as the client count grows."""
+    print("Broadcast encode cost per tick (32 players in the game state)")
+    print(f"{'clients':>8} {'encodes':>8} {'encode us':>10} {'per-client encode us':>21}")
+    encode = lambda x: bytes(json.dumps(x), "utf8")
+    for clients in (1, 10, 100, 500, 1000):
+        server = _Server()
+        server._socket = _NullSocket()
+        server.game_state = make_game_state(32)
+        server.clients = {("127.0.0.1", 20000 + i) for i in range(clients)}
+        # Wrap the codec to count calls and the time spent in it.
+        encodes = 0
+        encode_ns = 0
+
+        def timed_encode(packet):
+            nonlocal encodes, encode_ns
+            start = time.perf_counter_ns()
+            data = encode(packet)
+            encode_ns += time.perf_counter_ns() - start
+            encodes += 1
+            return data
+        server.encode = timed_encode
+        ticks = 20
+
+        async def run_ticks():
+            for _ in range(ticks):
+                await server._send_frame(server._build_frame())
+        anyio.run(run_ticks)  # noqa
+        # Compare against encoding the game state once for every client, like the old send path.
+        start = time.perf_counter_ns()
+        for address in server.clients:
+            encode(server.game_state)
+        per_client_ns = time.perf_counter_ns() - start
+        print(f"{clients:>8} {encodes // ticks:>8} {encode_ns / ticks / 1000:>10.1f} {per_client_ns / 1000:>21.1f}")
+
+
+def bench_delta():
+    """Measure the bytes sent to each client per tick with and without delta compression."""
+    print("Game state bytes per client per tick (JSON, 10% of players moving each tick)")
+    print(f"{'players':>8} {'keyframe':>10} {'delta':>10} {'ratio':>7}")
+    encode = lambda x: bytes(json.dumps(x), "utf8")
+    for player_count in (10, 100, 500, 2000):
+        game_state = make_game_state(player_count)
+        history = snapshot.History(SNAPSHOT_HISTORY)
+        keyframe_bytes = delta_bytes = 0
+        ticks = 30
+        for tick in range(ticks):
+            # Move a random tenth of the players.
+            for player_id in random.sample(range(player_count), max(1, player_count // 10)):
+                x, y = game_state["player_dicts"][player_id]["position"]
+                game_state["player_dicts"][player_id]["position"] = ((x + 1) % SCREEN_SIZE[0], y)
+            state = snapshot.copy_state(game_state)
+            # The client always acknowledges the previous tick.
+            keyframe_bytes += len(encode(history.make_packet(tick, state, None)))
+            delta_bytes += len(encode(history.make_packet(tick, state, tick - 1)))
+            history.add(tick, state)
+        print(f"{player_count:>8} {keyframe_bytes // ticks:>10} {delta_bytes // ticks:>10} "
+              f"{keyframe_bytes / delta_bytes:>6.1f}x")
+
+
+def bench_sequence():
+    """Measure the cost of numbering every packet of a tick with a sequence number header."""
+    print("Frame build cost per tick with and without sequence numbers (binary, 32 players)")
+    print(f"{'clients':>8} {'plain us':>10} {'numbered us':>12} {'overhead':>9}")
+    for clients in (10, 100, 1000):
+        times = []
+        for sequence_header in (False, True):
+            server = _Server()
+            server.use_codec(codec.BINARY)
+            server.sequence_header = sequence_header
+            server.game_state = make_game_state(32)
+            server.clients = {("127.0.0.1", 20000 + i) for i in range(clients)}
+            ticks = 50
+            start = time.perf_counter_ns()
+            for _ in range(ticks):
+                server._build_frame()
+            times.append((time.perf_counter_ns() - start) / ticks / 1000)
+        print(f"{clients:>8} {times[0]:>10.1f} {times[1]:>12.1f} {times[1] / times[0]:>8.1f}x")
+
+
+def bench_metrics():
+    """Measure what the metrics cost per received datagram and per tick, against leaving them off."""
+    print("Server cost with metrics off and on (binary, numbered packets)")
+    print(f"{'':>12} {'off us':>8} {'on us':>8}")
+    datagram = channel.HEADER.pack(0, 0, 0) + codec.BINARY.encode({"event": Event.INPUT, "seq": 1, "keys": 1})
+    receive_times = []
+    tick_times = []
+    for recording in (None, metrics.Metrics()):
+        server = _Server()
+        server.use_codec(codec.BINARY)
+        server.sequence_header = True
+        server.metrics = recording
+        server.game_state = make_game_state(32)
+        server.clients = {("127.0.0.1", 20000 + i) for i in range(100)}
+        datagrams = 100_000
+        start = time.perf_counter_ns()
+        for i in range(datagrams):
+            server._receive(datagram, ("127.0.0.1", 20000 + i % 100))
+        receive_times.append((time.perf_counter_ns() - start) / datagrams / 1000)
+        server._in_queue.clear()
+        ticks = 100
+        start = time.perf_counter_ns()
+        for _ in range(ticks):
+            if recording is None:
+                server._build_frame()
+            else:
+                server._measured_tick(0)
+        tick_times.append((time.perf_counter_ns() - start) / ticks / 1000)
+    print(f"{'datagram':>12} {receive_times[0]:>8.2f} {receive_times[1]:>8.2f}")
+    print(f"{'tick (100)':>12} {tick_times[0]:>8.1f} {tick_times[1]:>8.1f}")
+
+
+def bench_codec():
+    """Compare the size and speed of the binary codec against the JSON codec."""
+    print("Codec bytes per packet and encode/decode ns per packet")
+    print(f"{'packet':>16} {'json B':>7} {'binary B':>9} {'json enc':>9} {'bin enc':>8} {'json dec':>9} {'bin dec':>8}")
+    update = make_game_state(32)
+    history = snapshot.History(SNAPSHOT_HISTORY)
+    history.add(0, snapshot.copy_state(update))
+    update["player_dicts"][3]["position"] = (1.5, 2.5)
+    packets = {
+        "JOIN": {"event": Event.JOIN, "name": "Player 1"},
+        "JOINED": {"event": Event.JOINED, "id": 7, "position": [400, 300]},
+        "MOVE": {"event": Event.MOVE, "seq": 42, "position": [401.25, 299.5]},
+        "ACK": {"event": Event.ACK, "tick": 12345},
+        "INPUT": {"event": Event.INPUT, "seq": 42, "keys": Input.RIGHT | Input.UP},
+        "UPDATE (32)": update,
+        "UPDATE (delta)": history.make_packet(1, update, 0),
+    }
+    repeats = 2000
+    for name, packet in packets.items():
+        row = []
+        for packet_codec in (codec.JSON, codec.BINARY):
+            data = packet_codec.encode(packet)
+            start = time.perf_counter_ns()
+            for _ in range(repeats):
+                packet_codec.encode(packet)
+            encode_ns = (time.perf_counter_ns() - start) // repeats
+            start = time.perf_counter_ns()
+            for _ in range(repeats):
+                packet_codec.decode(data)
+            decode_ns = (time.perf_counter_ns() - start) // repeats
+            row.append((len(data), encode_ns, decode_ns))
+        (json_bytes, json_encode, json_decode), (binary_bytes, binary_encode, binary_decode) = row
+        print(f"{name:>16} {json_bytes:>7} {binary_bytes:>9} {json_encode:>9} {binary_encode:>8} "
+              f"{json_decode:>9} {binary_decode:>8}")
+
+
+def bench_interest():
+    """Measure building every client's state update with and without interest management."""
+    print("Per-tick state update cost for all clients (binary codec, players spread over 4000x4000)")
+    print(f"{'players':>8} {'full ms':>8} {'full KB':>8} {'interest ms':>12} {'interest KB':>12}")
+    world_size = 4000
+    radius = 300
+    for player_count in (100, 500, 2000):
+        player_dicts = {
+            player_id: {"name": f"Player {player_id}", "position": [random.uniform(0, world_size),
+                                                                   random.uniform(0, world_size)]}
+            for player_id in range(player_count)
+        }
+        grid = spatial.Grid(radius / 2, wrap=(world_size, world_size))
+        for player_id, attrs in player_dicts.items():
+            grid.move(player_id, attrs["position"])
+        # Without interest management, every client receives the whole world.
+        start = time.perf_counter_ns()
+        data = codec.BINARY.encode({"event": Event.UPDATE, "player_dicts": player_dicts})
+        full_ms = (time.perf_counter_ns() - start) / 1e6
+        full_bytes = len(data) * player_count
+        # With interest management, each client receives the cells near its own, like gameserver.interest_view,
+        # encoding each cell once and joining the update once for all the clients in the same cell.
+        # The first tick fills the grid's neighbourhood cache, so the second tick is timed.
+        for _ in range(2):
+            start = time.perf_counter_ns()
+            fragments = {}
+            views = {}
+            interest_bytes = 0
+            for attrs in player_dicts.values():
+                center = grid.cell(attrs["position"])
+                view = views.get(center)
+                if view is None:
+                    client_fragments = []
+                    for cell in grid.cells_near(center, radius):
+                        if cell not in fragments:
+                            cell_players = {player_id: player_dicts[player_id] for player_id in grid.cells[cell]}
+                            fragments[cell] = codec.BINARY.encode_players(cell_players), len(cell_players)
+                        client_fragments.append(fragments[cell])
+                    view = views[center] = codec.BINARY.join_players(client_fragments)
+                interest_bytes += len(view)
+            interest_ms = (time.perf_counter_ns() - start) / 1e6
+        print(f"{player_count:>8} {full_ms:>8.2f} {full_bytes / 1024:>8.0f} {interest_ms:>12.2f} "
+              f"{interest_bytes / 1024:>12.0f}")
+
+
+def bench_spatial():
+    """Compare spatial grid queries against linear scans over every position."""
+    print("Spatial queries in us per query (world scales with entity count, radius 100, cell size 100)")
+    print(f"{'entities':>9} {'grid build ms':>14} {'grid radius':>12} {'scan radius':>12} "
+          f"{'grid nearest':>13} {'scan nearest':>13}")
+    for entities in (1000, 10000, 100000):
+        # Keep the density the same, at one entity per 100x100 area.
+        world_size = int((entities * 100 * 100) ** 0.5)
+        positions = {key: (random.uniform(0, world_size), random.uniform(0, world_size)) for key in range(entities)}
+        grid = spatial.Grid(100)
+        start = time.perf_counter_ns()
+        for key, position in positions.items():
+            grid.move(key, position)
+        build_ms = (time.perf_counter_ns() - start) / 1e6
+        queries = [(random.uniform(0, world_size), random.uniform(0, world_size)) for _ in range(50)]
+
+        def scan_radius(point, radius):
+            return [key for key, (x, y) in positions.items() if (x - point[0]) ** 2 + (y - point[1]) ** 2 <= radius ** 2]
+
+        def scan_nearest(point):
+            return min(positions, key=lambda key: (positions[key][0] - point[0]) ** 2 + (positions[key][1] - point[1]) ** 2)
+        timings = []
+        for query in (lambda p: grid.query_radius(p, 100), lambda p: scan_radius(p, 100),
+                      grid.nearest, scan_nearest):
+            start = time.perf_counter_ns()
+            for point in queries:
+                query(point)
+            timings.append((time.perf_counter_ns() - start) / len(queries) / 1000)
+        print(f"{entities:>9} {build_ms:>14.1f} {timings[0]:>12.1f} {timings[1]:>12.1f} "
+              f"{timings[2]:>13.1f} {timings[3]:>13.1f}")
+
+
+def bench_send():
+    """Compare the packets per second of the server's send paths over loopback."""
+    print("Loopback send rate in packets per second (one tick with 100-byte packets)")
+    print(f"{'clients':>8} {'anyio':>10} {'sendto':>10} {'sendmmsg':>10}")
+    # All the packets go to one socket that never reads them, so only the sending side is measured.
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sink:
+        sink.bind(("127.0.0.1", 0))
+        for clients in (100, 1000, 5000):
+            frame = [([sink.getsockname()] * clients, bytes(100))]
+            rates = []
+            for path in ("anyio", "sendto", "sendmmsg"):
+                server = _Server()
+                server.use_sendmmsg = path == "sendmmsg"
+                if path == "sendmmsg" and not mmsg.AVAILABLE:
+                    rates.append(float("nan"))
+                    continue
+
+                async def send_ticks():
+                    if path == "anyio":
+                        server._socket = await anyio.create_udp_socket(local_host="127.0.0.1")
+                    else:
+                        server._raw_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        server._raw_socket.setblocking(False)
+                    start = time.perf_counter_ns()
+                    for _ in range(ticks):
+                        await server._send_frame(frame)
+                    elapsed = time.perf_counter_ns() - start
+                    if server._socket is not None:
+                        await server._socket.aclose()
+                    else:
+                        server._raw_socket.close()
+                    return elapsed
+                ticks = 10
+                elapsed = anyio.run(send_ticks)  # noqa
+                rates.append(clients * ticks / elapsed * 1e9)
+            print(f"{clients:>8} {rates[0]:>10.0f} {rates[1]:>10.0f} {rates[2]:>10.0f}")
+
+
+def bench_backends():
+    """Compare the server backends on loopback, with every simulated client sending and receiving each tick."""
+    print("Server backends on loopback (30 ticks at 30 Hz, 100-byte packets)")
+    print(f"{'clients':>8} {'backend':>8} {'send ms/tick':>13} {'received':>9} {'CPU s':>6}")
+    backends = [("anyio", False), ("batch", False), ("asyncio", False)]
+    if importlib.util.find_spec("uvloop") is not None:
+        backends.append(("asyncio", True))
+    for clients in (100, 1000, 5000):
+        for backend, use_uvloop in backends:
+            # Find a free port for the server.
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                probe.bind(("127.0.0.1", 0))
+                port = probe.getsockname()[1]
+            # The simulated clients all share one socket, which receives on every loopback address.
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sink:
+                sink.bind(("0.0.0.0", 0))
+                sink_port = sink.getsockname()[1]
+                server = _Server()
+                server.backend = backend
+                server.use_uvloop = use_uvloop
+                server.game_state = bytes(100)
+                server.clients = {(f"127.0.{i // 250}.{i % 250 + 1}", sink_port) for i in range(clients)}
+                send_times = []
+
+                def tick(dt):
+                    for _ in server:
+                        pass
+                    send_times.append(server.send_time_ns)
+                    if len(send_times) >= 30:
+                        server.shutdown()
+                start = time.process_time()
+                thread = threading.Thread(target=server.run, args=("127.0.0.1", port, tick))
+                thread.start()
+                while not server.running:
+                    time.sleep(0.001)
+                # Send one packet per client each tick while the server runs.
+                sent = 0
+                while thread.is_alive():
+                    for _ in range(clients):
+                        sink.sendto(bytes(20), ("127.0.0.1", port))
+                    sent += clients
+                    time.sleep(1 / 30)
+                thread.join()
+                cpu = time.process_time() - start
+            name = "uvloop" if use_uvloop else backend
+            print(f"{clients:>8} {name:>8} {sum(send_times) / len(send_times) / 1e6:>13.2f} "
+                  f"{server.recv_datagrams / sent:>8.0%} {cpu:>6.2f}")
+
+
+def bench_client_cpu():
+    """Measure the CPU used by a running client while idle and while busy."""
+    print("Client CPU usage over 2 seconds, as a share of one core")
+    print(f"{'workload':>24} {'CPU':>6}")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sink:
+        sink.bind(("127.0.0.1", 0))
+        for workload in ("idle", "sending every 1 ms"):
+            connection = _Connection()
+            usage = 0.0
+
+            async def app():
+                nonlocal usage
+                await connection.wait_connected()
+                start_cpu, start = time.process_time(), time.perf_counter()
+                if workload == "idle":
+                    await anyio.sleep(2)
+                else:
+                    while time.perf_counter() - start < 2:
+                        connection.send(bytes(20))
+                        await anyio.sleep(0.001)
+                usage = (time.process_time() - start_cpu) / (time.perf_counter() - start)
+                connection.shutdown()
+            connection.run(app, address=sink.getsockname())
+            print(f"{workload:>24} {usage:>6.1%}")
+
+
+def bench_players():
+    """Compare a movement tick of the dictionary player store against the NumPy array store."""
+    if not players.AVAILABLE:
+        print("Skipping the player store benchmark, since NumPy isn't installed")
+        return
+    print("Movement tick time in ms (half of the players moving)")
+    print(f"{'players':>8} {'dicts':>8} {'arrays':>8} {'arrays + dicts':>15}")
+    for count in (10000, 50000, 100000):
+        player_dicts = {}
+        player_inputs = {}
+        arrays = players.PlayerArrays()
+        for player_id in range(count):
+            position = [random.uniform(0, SCREEN_SIZE[0]), random.uniform(0, SCREEN_SIZE[1])]
+            keys = random.choice((Input.RIGHT, Input.LEFT | Input.UP, Input.DOWN)) if player_id % 2 else 0
+            player_dicts[player_id] = {"name": f"Player {player_id}", "position": position, "seq": 0}
+            player_inputs[player_id] = keys
+            arrays.add(player_id, player_dicts[player_id]["name"], position)
+            arrays.set_input(player_id, keys, 0)
+        dt = 1 / TICK_RATE
+        # The dictionary store moves each player in a Python loop, like gameserver without NumPy.
+        start = time.perf_counter_ns()
+        for player_id, keys in player_inputs.items():
+            if keys:
+                position = prediction.apply_movement(player_dicts[player_id]["position"],
+                                                     prediction.input_movement(keys, dt))
+                player_dicts[player_id]["position"] = position
+        dict_ms = (time.perf_counter_ns() - start) / 1e6
+        start = time.perf_counter_ns()
+        arrays.step(dt)
+        array_ms = (time.perf_counter_ns() - start) / 1e6
+        # Building the player dictionaries to send from the arrays, like gameserver with NumPy.
+        start = time.perf_counter_ns()
+        arrays.step(dt)
+        arrays.as_dicts()
+        build_ms = (time.perf_counter_ns() - start) / 1e6
+        print(f"{count:>8} {dict_ms:>8.2f} {array_ms:>8.2f} {build_ms:>15.2f}")
+
+
+def bench_memory():
+    """Measure the memory used per player session, before and after a long run of players joining and leaving.
+
+    Every structure the game server keeps for a player is included: its client id, id allocator, grid entry,
+    and either its player dictionary and held keys, or its row in the player arrays.
+    With the arrays, the player dictionaries are built every tick to be sent, so their size is shown separately.
+    """
+    print("Memory per player session in bytes (tracemalloc), with 50,000 players online")
+    print(f"{'store':>10} {'start':>8} {'after churn':>12} {'per tick':>9} {'highest id':>11}")
+    sessions = 50000
+    for store in ("dicts", "arrays"):
+        if store == "arrays" and not players.AVAILABLE:
+            print(f"{store:>10} skipped, since NumPy isn't installed")
+            continue
+        tracemalloc.start()
+        ids = players.IdAllocator()
+        client_ids = {}
+        grid = spatial.Grid(INTEREST_CELL_SIZE, wrap=SCREEN_SIZE)
+        player_dicts = {}
+        player_inputs = {}
+        arrays = players.PlayerArrays() if store == "arrays" else None
+
+        def join(port):
+            player_id = client_ids[("127.0.0.1", port)] = ids.allocate()
+            position = [random.uniform(0, SCREEN_SIZE[0]), random.uniform(0, SCREEN_SIZE[1])]
+            if arrays is not None:
+                arrays.add(player_id, f"Player {port}", position)
+                arrays.set_input(player_id, Input.RIGHT, 1)
+            else:
+                player_dicts[player_id] = {"name": f"Player {port}", "position": position, "seq": 1}
+                player_inputs[player_id] = Input.RIGHT
+            grid.move(player_id, position)
+
+        def leave(address):
+            player_id = client_ids.pop(address)
+            if arrays is not None:
+                arrays.remove(player_id)
+            else:
+                del player_dicts[player_id]
+                del player_inputs[player_id]
+            grid.remove(player_id)
+            ids.release(player_id)
+        for port in range(sessions):
+            join(port)
+        start = tracemalloc.get_traced_memory()[0] / sessions
+        # Simulate a long uptime, with a tenth of the players leaving and new ones joining many times over.
+        next_port = sessions
+        for _ in range(50):
+            for address in random.sample(list(client_ids), sessions // 10):
+                leave(address)
+            for _ in range(sessions // 10):
+                join(next_port)
+                next_port += 1
+        held = tracemalloc.get_traced_memory()[0]
+        after = held / sessions
+        # Build the player dictionaries a tick sends, which only the arrays have to do.
+        tracemalloc.reset_peak()
+        tick_dicts = arrays.as_dicts() if arrays is not None else player_dicts
+        per_tick = (tracemalloc.get_traced_memory()[1] - held) / sessions
+        del tick_dicts
+        tracemalloc.stop()
+        print(f"{store:>10} {start:>8.0f} {after:>12.0f} {per_tick:>9.0f} {max(client_ids.values()):>11}")
+
+
+# Maps benchmark names to their functions.
+BENCHMARKS = {
+    "broadcast": bench_broadcast,
+    "delta": bench_delta,
+    "codec": bench_codec,
+    "sequence": bench_sequence,
+    "metrics": bench_metrics,
+    "interest": bench_interest,
+    "spatial": bench_spatial,
+    "send": bench_send,
+    "backends": bench_backends,
+    "client_cpu": bench_client_cpu,
+    "players": bench_players,
+    "memory": bench_memory,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
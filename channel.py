@@ -0,0 +1,193 @@
+import struct
+import time
+from collections import deque
+
+# Typing imports.
+from typing import Optional
+
+# Every packet starts with a header of little-endian 32-bit integers: the sequence number its sender gave it,
+# the number of the last reliable message the sender received in order, piggybacking the acknowledgement,
+# and the number of the reliable message the packet carries, or 0 if it is unreliable.
+HEADER = struct.Struct("<III")
+
+# How many sequence numbers before the newest one are remembered, to tell late packets from duplicates.
+WINDOW = 64
+# The most reliable messages that can be waiting for an acknowledgement. Any more wait to be sent.
+RELIABLE_WINDOW = 32
+# Bounds of the time to wait for an acknowledgement before resending a reliable message, in nanoseconds.
+INITIAL_RTO = 1_000_000_000
+MIN_RTO = 200_000_000
+MAX_RTO = 5_000_000_000
+
+
+class RoundTrip:
+    """The smoothed round trip time to a peer and its variation, estimated from measurements like RFC 6298."""
+    def __init__(self):
+        self.srtt_ns: Optional[int] = None  # Smoothed round trip time in nanoseconds.
+        self.rttvar_ns: int = 0  # Smoothed variation of the round trip time in nanoseconds.
+        self.latest_ns: Optional[int] = None  # The latest measurement in nanoseconds.
+        self.samples: int = 0  # Number of measurements.
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """The smoothed round trip time in seconds, or ``None`` before the first measurement."""
+        return self.srtt_ns / 1_000_000_000 if self.srtt_ns is not None else None
+
+    @property
+    def jitter(self) -> float:
+        """How much the round trip time varies, in seconds."""
+        return self.rttvar_ns / 1_000_000_000
+
+    def add(self, sample: int):
+        """Update the estimate with a new round trip time measurement in nanoseconds."""
+        if self.srtt_ns is None:
+            self.srtt_ns = sample
+            self.rttvar_ns = sample // 2
+        else:
+            self.rttvar_ns = (3 * self.rttvar_ns + abs(self.srtt_ns - sample)) // 4
+            self.srtt_ns = (7 * self.srtt_ns + sample) // 8
+        self.latest_ns = sample
+        self.samples += 1
+
+
+class Peer:
+    """Sequence numbering and reliable messages for one remote end of a connection.
+
+    Packets sent to the peer are numbered with ``Peer.stamp(data)``,
+    and packets received from it are checked and unwrapped with ``Peer.accept(data)``.
+    Lost, late and duplicated packets are counted along the way.
+
+    Reliable messages are queued with ``Peer.queue_reliable(data)``, and ``Peer.due()`` returns the ones to send,
+    which includes resending the ones that weren't acknowledged within the retransmission timeout.
+    They are delivered in order on the other end, and acknowledged in the header of every packet sent back.
+    """
+    def __init__(self):
+        self.next_seq: int = 0  # The sequence number of the next packet sent.
+        self.latest: Optional[int] = None  # The newest sequence number received.
+        self.received: int = 0  # Number of packets received, without duplicates.
+        self.lost: int = 0  # Number of skipped sequence numbers that haven't arrived (yet).
+        self.reordered: int = 0  # Number of packets that arrived after a newer one.
+        self.duplicates: int = 0  # Number of packets dropped for having already arrived, or being too old to tell.
+        # Bit ``i`` is set if the packet numbered ``latest - i`` has been received.
+        self._window: int = 0
+
+        # Reliable messages sent.
+        self.next_reliable: int = 1  # The number of the next reliable message queued.
+        self.retransmits: int = 0  # Number of times a reliable message was resent.
+        self.round_trip: RoundTrip = RoundTrip()  # Round trip time measured from acknowledgements.
+        self.rto_ns: int = INITIAL_RTO  # How long to wait for an acknowledgement before resending.
+        # Messages sent but not acknowledged by number, with when they were first sent,
+        # how many times they were resent and when to resend them next.
+        self._unacked: dict[int, list] = {}
+        self._waiting: deque[bytes] = deque()  # Messages waiting for room in the window.
+        # Reliable messages received.
+        self.reliable_received: int = 0  # The number of the last reliable message received in order.
+        self.needs_ack: bool = False  # Whether a reliable message arrived since the last packet sent back.
+        self._held: dict[int, bytes] = {}  # Reliable messages that arrived ahead of a missing one.
+
+    @property
+    def pending(self) -> bool:
+        """Whether there are reliable messages that haven't been acknowledged yet."""
+        return bool(self._unacked or self._waiting)
+
+    def stamp(self, data: bytes, reliable: int = 0) -> bytes:
+        """Put the next header in front of an encoded packet.
+
+        ``reliable`` is the number of the reliable message the packet carries, as returned by ``Peer.due()``.
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        self.needs_ack = False
+        return HEADER.pack(seq, self.reliable_received, reliable) + data
+
+    def queue_reliable(self, data: bytes):
+        """Queue an encoded message to be sent reliably. It is sent once ``Peer.due()`` returns it."""
+        self._waiting.append(data)
+
+    def due(self) -> list[tuple[int, bytes]]:
+        """Get the reliable messages that should be sent now, with their numbers, to pass on to ``Peer.stamp``.
+
+        These are newly queued messages that fit in the window, and messages whose retransmission timeout ran out.
+        Each resend doubles the timeout of that message.
+        """
+        now = time.monotonic_ns()
+        while self._waiting and len(self._unacked) < RELIABLE_WINDOW:
+            self._unacked[self.next_reliable] = [self._waiting.popleft(), now, -1, now]
+            self.next_reliable += 1
+        messages = []
+        for number, message in self._unacked.items():
+            if message[3] <= now:
+                message[2] += 1
+                if message[2]:
+                    self.retransmits += 1
+                message[3] = now + min(self.rto_ns << message[2], MAX_RTO)
+                messages.append((number, message[0]))
+        return messages
+
+    def next_deadline(self) -> Optional[int]:
+        """When ``Peer.due()`` will next have messages to send, in monotonic nanoseconds, or ``None`` if never."""
+        return min((message[3] for message in self._unacked.values()), default=None)
+
+    def accept(self, data: bytes) -> tuple[str, list[bytes]]:
+        """Check and unwrap a received packet.
+
+        Returns the status from ``Peer.receive`` and the payloads to deliver, in order.
+        There are none for duplicates, packets that only carry an acknowledgement,
+        and reliable messages that arrived early or were already delivered.
+        A reliable message filling a gap also delivers the messages held back behind it.
+        """
+        seq, ack, reliable = HEADER.unpack_from(data)
+        status = self.receive(seq)
+        if status == "duplicate":
+            return status, []
+        if self._unacked:
+            self._acknowledge(ack)
+        payload = data[HEADER.size:]
+        if not reliable:
+            return status, [payload] if payload else []
+        # Acknowledge the message even if it was already delivered, since the acknowledgement may have been lost.
+        self.needs_ack = True
+        if reliable <= self.reliable_received or reliable > self.reliable_received + WINDOW:
+            return status, []
+        self._held[reliable] = payload
+        delivered = []
+        while self.reliable_received + 1 in self._held:
+            self.reliable_received += 1
+            delivered.append(self._held.pop(self.reliable_received))
+        return status, delivered
+
+    def _acknowledge(self, ack: int):
+        """Forget the reliable messages up to number ``ack``, which the peer received."""
+        now = time.monotonic_ns()
+        for number in [number for number in self._unacked if number <= ack]:
+            data, sent, resends, deadline = self._unacked.pop(number)
+            # Only messages sent once give a clear round trip time.
+            if resends == 0:
+                self.round_trip.add(now - sent)
+                self.rto_ns = max(MIN_RTO, min(self.round_trip.srtt_ns + 4 * self.round_trip.rttvar_ns, MAX_RTO))
+
+    def receive(self, seq: int) -> str:
+        """Record that the packet numbered ``seq`` arrived.
+
+        Returns "new" if it is the newest packet so far, "late" if it arrived after a newer packet,
+        and "duplicate" if it already arrived or is too old to tell, in which case it should be dropped.
+        """
+        if self.latest is None or seq > self.latest:
+            if self.latest is not None:
+                # Anything skipped over is lost until it turns up late.
+                self.lost += seq - self.latest - 1
+                gap = seq - self.latest
+                self._window = (self._window << gap) & ((1 << WINDOW) - 1) if gap < WINDOW else 0
+            self._window |= 1
+            self.latest = seq
+            self.received += 1
+            return "new"
+        age = self.latest - seq
+        if age >= WINDOW or self._window & (1 << age):
+            self.duplicates += 1
+            return "duplicate"
+        self._window |= 1 << age
+        self.lost -= 1
+        self.reordered += 1
+        self.received += 1
+        return "late"
@@ -1,14 +1,23 @@
+import abc
+import math
+import socket
+import struct
+import time
 from collections import deque
 
 import anyio
 
+import channel
+from settings import Event
+
 # Typing imports.
-from typing import Callable, Awaitable, Optional, Any
-from anyio.abc import ConnectedUDPSocket, CancelScope
+from typing import Callable, Awaitable, Optional, Any, Collection
+from anyio.abc import ConnectedUDPSocket, CancelScope, TaskGroup
+from anyio.streams.memory import MemoryObjectSendStream, MemoryObjectReceiveStream
 
 
-class _Connection:
-    """Represents a remote connection to a server.
+class _Session(abc.ABC):
+    """The packet handling shared by ``_Connection`` and the connections of a ``_ConnectionManager``.
 
     It can be iterated over to receive packets.
     Packets will be decoded with ``_Connection.decode(packet)``.
@@ -17,18 +26,204 @@ class _Connection:
         # Public attributes.
         self.encode: Callable[[Any], bytes] = lambda x: x
         self.decode: Callable[[bytes], Any] = lambda x: x
+        # When set, this packet is sent to let the server know when the connection is closed or shut down.
+        self.leave_packet: Any = None
+        # Events where only the newest packet matters, like game state updates.
+        # When several of these are waiting, the older ones are dropped without being decoded.
+        # Needs ``_Connection.peek(packet)`` to return the event and tick of a packet, which ``use_codec`` sets up.
+        self.latest_only: Collection[Any] = ()
+        self.peek: Callable[[bytes], tuple[Any, Optional[int]]] = lambda x: (None, None)
+        self.dropped: int = 0  # Number of packets dropped for being superseded by newer ones.
+        # Number of datagrams dropped for being too short for the header, or failing to peek at or decode.
+        self.malformed: int = 0
+        # Whether packets carry a sequence number header, to drop duplicates and count lost and late packets.
+        # Must match ``_Server.sequence_header`` on the server.
+        self.sequence_header: bool = False
+        self.peer: channel.Peer = channel.Peer()  # Sequence numbering of the current connection.
+        # Seconds between the PING packets sent to the server to measure the round trip time.
+        # The server's pings are only answered while this is set. None disables pings.
+        # Pings need a codec supporting ``settings.Event.PING`` and ``settings.Event.PONG``.
+        self.ping_interval: Optional[float] = None
+        self.round_trip: channel.RoundTrip = channel.RoundTrip()  # Round trip time of the current connection.
 
         # Private variables.
-        self._socket: Optional[ConnectedUDPSocket] = None
         self._address: tuple[Optional[str], Optional[int]] = None, None  # The remote address connected to.
-        self._out_queue: deque[bytes] = deque()  # Outgoing packets.
         self._in_queue: deque[bytes] = deque()  # Incoming packets.
+        # The newest packet of each event in ``_Connection.latest_only``, with its tick.
+        self._latest: dict[Any, tuple[Optional[int], bytes]] = {}
+
+    @property
+    def address(self) -> tuple[Optional[str], Optional[int]]:
+        """The address connected to as a tuple of ``host``, ``port``.
+
+        Returns ``(None,None)`` if the connection is closed or not running.
+        """
+        return self._address
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """The smoothed round trip time to the server in seconds, measured with pings.
+
+        Returns ``None`` until the server has answered a ping.
+        ``Connection.round_trip.jitter`` tells how much it varies.
+        """
+        return self.round_trip.rtt
+
+    @property
+    @abc.abstractmethod
+    def closed(self) -> bool:
+        """Whether the connection is closed.
+
+        A closed connection won't receive any packets and will silently swallow any sent packets.
+        """
+
+    @abc.abstractmethod
+    def _transmit(self, data: bytes):
+        """Send an encoded packet to the connected address."""
+
+    def _receive(self, packet: bytes):
+        """Handle a datagram that arrived from the connected address."""
+        if not self.sequence_header:
+            self._checked_queue(packet)
+            return
+        if len(packet) < channel.HEADER.size:
+            self.malformed += 1
+            return
+        for payload in self._unwrap(packet):
+            self._checked_queue(payload)
+        if self.peer.needs_ack:
+            # Acknowledge reliable packets right away, instead of waiting for something to send.
+            self._transmit(self.peer.stamp(b""))
+
+    def _checked_queue(self, packet: bytes):
+        """Queue a received packet, dropping it and counting it as malformed if it can't be peeked at or decoded."""
+        try:
+            self._queue(packet)
+        except (ValueError, KeyError, IndexError, TypeError, struct.error):
+            self.malformed += 1
+
+    def _unwrap(self, packet: bytes) -> list[bytes]:
+        """Strip the header off a received packet, returning the payloads to queue.
+
+        Duplicates are dropped, and so are late packets of ``latest_only`` events, which newer ones have replaced.
+        """
+        status, payloads = self.peer.accept(packet)
+        if status == "late" and self.latest_only:
+            kept = [payload for payload in payloads if self.peek(payload)[0] not in self.latest_only]
+            self.dropped += len(payloads) - len(kept)
+            return kept
+        return payloads
+
+    def _queue(self, packet: bytes):
+        """Queue a received packet, replacing the waiting packet of the same event if it is in ``latest_only``.
+
+        Pings and pongs are handled right away instead.
+        """
+        if self.ping_interval is not None and self.peek(packet)[0] in (Event.PING, Event.PONG):
+            self._handle_ping(self.decode(packet))
+            return
+        if not self.latest_only:
+            self._in_queue.append(packet)
+            return
+        event, tick = self.peek(packet)
+        if event not in self.latest_only:
+            self._in_queue.append(packet)
+            return
+        latest = self._latest.get(event)
+        if latest is not None:
+            self.dropped += 1
+            # Keep the waiting packet if this one is older and arrived out of order.
+            if tick is not None and latest[0] is not None and tick < latest[0]:
+                return
+        self._latest[event] = tick, packet
+
+    def _handle_ping(self, packet: dict):
+        """Answer a ping from the server, or measure the round trip time from the answer to one of ours."""
+        if packet["event"] == Event.PING:
+            self._transmit(self._encode({"event": Event.PONG, "time": packet["time"], "hold": 0}))
+        else:
+            self.round_trip.add(time.monotonic_ns() - packet["time"] - packet["hold"])
+
+    def use_codec(self, codec: Any):
+        """Encode and decode packets with the ``encode``, ``decode`` and ``peek`` functions of a codec,
+        like ``codec.BINARY``.
+        """
+        self.encode = codec.encode
+        self.decode = codec.decode
+        self.peek = codec.peek
+
+    def send(self, packet: Any, reliable: bool = False):
+        """Queue packet to be sent to the connected address.
+
+        If the connection is closed or not running, nothing is queued.
+        The packet will be encoded with ``_Connection.encode(packet)``.
+        A ``reliable`` packet is resent until the server acknowledges it, and delivered in order with
+        the other reliable packets. This needs ``_Connection.sequence_header``, otherwise it is sent normally.
+        """
+        if self.closed:
+            return
+        if reliable and self.sequence_header:
+            self.peer.queue_reliable(self.encode(packet))
+            self._send_due()
+        else:
+            self._transmit(self._encode(packet))
+
+    def _send_due(self):
+        """Queue the reliable packets that are due to be sent or resent."""
+        for number, data in self.peer.due():
+            self._transmit(self.peer.stamp(data, number))
+
+    def _encode(self, packet: Any) -> bytes:
+        """Encode a packet, numbering it if ``_Connection.sequence_header`` is set."""
+        data = self.encode(packet)
+        return self.peer.stamp(data) if self.sequence_header else data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Any:
+        if self._in_queue:
+            return self.decode(self._in_queue.popleft())
+        elif self._latest:
+            # The newest packets of the latest only events come after everything else received.
+            return self.decode(self._latest.popitem()[1][1])
+        else:
+            raise StopIteration
+
+    async def pump(self, clear_packets: bool = False):
+        """Pump the network connection.
+
+        Should be called often while running to allow network events to occur.
+        Optionally clear the received packet queue if not clearing it through iteration.
+        """
+        if clear_packets:
+            self._in_queue.clear()
+            self._latest.clear()
+        await anyio.sleep(0)
+
+
+class _Connection(_Session):
+    """Represents a remote connection to a server.
+
+    It can be iterated over to receive packets.
+    Packets will be decoded with ``_Connection.decode(packet)``.
+    """
+    def __init__(self):
+        super().__init__()
+        # Private variables.
+        self._socket: Optional[ConnectedUDPSocket] = None
+        self._out_send: Optional[MemoryObjectSendStream[bytes]] = None  # Outgoing packets.
+        self._out_receive: Optional[MemoryObjectReceiveStream[bytes]] = None
         # Reference to the cancel scope of the task group to allow shutdown.
         self._cancel_scope: Optional[CancelScope] = None
 
         # Internal flag variables to determine requested socket state.
         self._close: bool = False  # Flag set when connection closing is requested.
         self._connect_address: Optional[tuple[str, int]] = None  # Flag set when new connection is requested.
+        # Events letting the tasks sleep until there is work for them.
+        self._wakeup: Optional[anyio.Event] = None  # Set when opening or closing the connection is requested.
+        self._opened: Optional[anyio.Event] = None  # Set when the connection is opened.
+        self._resend_wakeup: Optional[anyio.Event] = None  # Set when a reliable packet is sent.
 
     @property
     def address(self) -> tuple[Optional[str], Optional[int]]:
@@ -51,34 +246,70 @@ class _Connection:
     async def _close_socket(self):
         """Close the socket if open and update internal variables."""
         if not self.closed:
+            if self.leave_packet is not None:
+                # Let the server know we are leaving, straight through the socket,
+                # since the send task may not get another chance to run.
+                try:
+                    await self._socket.send(self._encode(self.leave_packet))
+                except (anyio.BrokenResourceError, OSError):
+                    # Leaving is best effort, the server will time the connection out anyway.
+                    pass
             await self._socket.aclose()
             # Update state variables.
             self._socket = None
             self._address = None, None
             # Clear queues to remove leftover packets.
-            self._out_queue.clear()
+            while True:
+                try:
+                    self._out_receive.receive_nowait()
+                except anyio.WouldBlock:
+                    break
             self._in_queue.clear()
+            self._latest.clear()
+            # Let the other tasks wait for the next connection.
+            self._opened = anyio.Event()
 
     async def _socket_loop(self):
         """The task responsible for opening and closing the connection."""
         while True:
+            # Requests made while this task is busy below set this event, so they are handled on the next pass.
+            self._wakeup = anyio.Event()
             # Connection closing has been requested.
             if self._close:
                 self._close = False
                 await self._close_socket()
             # Connection opening has been requested.
             if self._connect_address is not None:
+                address = self._connect_address
+                self._connect_address = None
                 # We must trigger anyio.ClosedResourceError in _send_loop and _recv_loop,
                 # to clear references to the old self._socket.
                 # Without this code, the old socket will linger and no new packets will be received.
                 await self._close_socket()
                 # Create new socket.
-                self._socket = await anyio.create_connected_udp_socket(*self._connect_address)
+                self._socket = await anyio.create_connected_udp_socket(*address)
                 # Update state variables.
-                self._address = self._connect_address
-                self._connect_address = None
-            # Yield to other tasks.
-            await anyio.sleep(0)
+                self._address = address
+                self.peer = channel.Peer()
+                self.round_trip = channel.RoundTrip()
+                # Wake up the tasks waiting for a connection.
+                self._opened.set()
+            # Sleep until opening or closing the connection is requested, unless it already was.
+            if not self._close and self._connect_address is None:
+                await self._wakeup.wait()
+
+    def _wake(self):
+        """Wake up the socket task to handle a connection request."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def wait_connected(self):
+        """Wait until the connection is connected to a remote address.
+
+        Returns immediately if it already is. Must be called while running.
+        """
+        if self.closed:
+            await self._opened.wait()
 
     def connect(self, host: str, port: int):
         """Connect to a new remote address.
@@ -88,6 +319,7 @@ class _Connection:
         If the connection isn't running, it will connect when ``Connection.run`` is called.
         """
         self._connect_address = host, port
+        self._wake()
 
     def close(self):
         """Close the current connection.
@@ -98,17 +330,25 @@ class _Connection:
         Does nothing if the connection is closed or not running.
         """
         self._close = True
+        self._wake()
+
+    def _transmit(self, data: bytes):
+        """Queue an encoded packet for the send task."""
+        self._out_send.send_nowait(data)
+
+    def send(self, packet: Any, reliable: bool = False):
+        """Queue packet to be sent to the connected address, like ``_Session.send``."""
+        super().send(packet, reliable)
+        if reliable and self._resend_wakeup is not None:
+            self._resend_wakeup.set()
 
     async def _send_loop(self):
         """The task responsible for sending packets."""
-        while True:
+        # Sleep until there is a packet, then send it out.
+        async for packet in self._out_receive:
             try:
-                if not self.closed and self._out_queue:
-                    # As long as there are packets, send them out.
-                    await self._socket.send(self._out_queue.popleft())
-                else:
-                    # Yield to other tasks.
-                    await anyio.sleep(0)
+                if not self.closed:
+                    await self._socket.send(packet)
             except anyio.ClosedResourceError:
                 # This is triggered whenever the socket is closed.
                 pass
@@ -121,41 +361,35 @@ class _Connection:
                     # Enter an infinite loop of waiting for packets.
                     # This is terminated by anyio.ClosedResourceError when the socket is closed.
                     async for packet in self._socket:
-                        self._in_queue.append(packet)
+                        self._receive(packet)
                 else:
-                    # Yield to other tasks.
-                    await anyio.sleep(0)
+                    # Sleep until the connection is opened.
+                    await self._opened.wait()
             except anyio.ClosedResourceError:
                 # This is triggered whenever the socket is closed.
                 pass
 
-    def send(self, packet: Any):
-        """Queue packet to be sent to the connected address.
-
-        If the connection is closed or not running, nothing is queued.
-        The packet will be encoded with ``_Connection.encode(packet)``.
-        """
-        if not self.closed:
-            self._out_queue.append(self.encode(packet))
-
-    def __iter__(self):
-        return self
-
-    def __next__(self) -> Any:
-        if self._in_queue:
-            return self.decode(self._in_queue.popleft())
-        else:
-            raise StopIteration
-
-    async def pump(self, clear_packets: bool = False):
-        """Pump the network connection.
+    async def _resend_loop(self):
+        """The task responsible for resending reliable packets that weren't acknowledged in time."""
+        while True:
+            deadline = self.peer.next_deadline()
+            if self.closed:
+                # Sleep until the connection is opened.
+                await self._opened.wait()
+            elif deadline is None:
+                # Sleep until a reliable packet is sent.
+                self._resend_wakeup = anyio.Event()
+                await self._resend_wakeup.wait()
+            else:
+                await anyio.sleep(max(deadline - time.monotonic_ns(), 0) / 1_000_000_000)
+                if not self.closed:
+                    self._send_due()
 
-        Should be called often while running to allow network events to occur.
-        Optionally clear the received packet queue if not clearing it through iteration.
-        """
-        if clear_packets:
-            self._in_queue.clear()
-        await anyio.sleep(0)
+    async def _ping_loop(self):
+        """The task responsible for pinging the server every ``_Connection.ping_interval`` seconds."""
+        while True:
+            await anyio.sleep(self.ping_interval)
+            self.send({"event": Event.PING, "time": time.monotonic_ns()})
 
     def run(self, coroutine: Callable[..., Awaitable], *args, address: Optional[tuple[str, int]] = None):
         """Run ``coroutine`` in a network aware context.
@@ -164,22 +398,34 @@ class _Connection:
         ``Connection.running`` is ``True`` inside of this function and ``False`` outside of it.
         An address can be given, which will be connected to as soon as possible.
         """
+        # Enter the async loop.
+        anyio.run(lambda: self.run_async(coroutine, *args, address=address))  # noqa
+
+    async def run_async(self, coroutine: Callable[..., Awaitable], *args, address: Optional[tuple[str, int]] = None):
+        """Like ``Connection.run``, but runs inside an event loop that is already running.
+
+        This lets many connections share one event loop, each run in its own task.
+        """
         # Set flag to connect to the address as soon as possible.
         self._connect_address = address
-
-        async def main():
-            async with anyio.create_task_group() as tg:
-                # Keep track of the cancel scope for easy shutdown later.
-                self._cancel_scope = tg.cancel_scope
-                # Run all of these tasks in parallel.
-                tg.start_soon(self._socket_loop, name="Socket Loop")  # noqa
-                tg.start_soon(self._send_loop, name="Send Loop")  # noqa
-                tg.start_soon(self._recv_loop, name="Receive Loop")  # noqa
-                tg.start_soon(coroutine, *args, name="Application Loop")
-            # Clean up by closing the socket.
-            await self._close_socket()
-        # Enter the async loop.
-        anyio.run(main)  # noqa
+        # Set up the queue and events the tasks wait on.
+        self._out_send, self._out_receive = anyio.create_memory_object_stream(math.inf)
+        self._opened = anyio.Event()
+        async with anyio.create_task_group() as tg:
+            # Keep track of the cancel scope for easy shutdown later.
+            self._cancel_scope = tg.cancel_scope
+            # Run all of these tasks in parallel.
+            tg.start_soon(self._socket_loop, name="Socket Loop")  # noqa
+            tg.start_soon(self._send_loop, name="Send Loop")  # noqa
+            tg.start_soon(self._recv_loop, name="Receive Loop")  # noqa
+            tg.start_soon(self._resend_loop, name="Resend Loop")  # noqa
+            if self.ping_interval is not None:
+                tg.start_soon(self._ping_loop, name="Ping Loop")  # noqa
+            tg.start_soon(coroutine, *args, name="Application Loop")
+        # Clean up by closing the socket.
+        await self._close_socket()
+        self._wakeup = None
+        self._resend_wakeup = None
 
     def shutdown(self):
         """Terminate the network processes and cause ``Connection.run`` to return.
@@ -199,5 +445,201 @@ class _Connection:
         return self._cancel_scope is not None
 
 
+class _ManagedConnection(_Session):
+    """A connection run by a ``_ConnectionManager``, opened with ``_ConnectionManager.open(host,port)``.
+
+    It sends and receives like ``_Connection``, but has no tasks of its own besides receiving on its socket:
+    packets are sent straight away, and the manager resends and pings for every connection at once.
+    """
+    def __init__(self, manager: "_ConnectionManager", address: tuple[str, int], raw_socket: socket.socket):
+        super().__init__()
+        self._address = address
+        self._manager: Optional[_ConnectionManager] = manager
+        self._socket: Optional[socket.socket] = raw_socket  # Shared with other connections if ``shared_socket``.
+        self._cancel_scope: Optional[CancelScope] = None  # Of the task receiving on the socket, if it has its own.
+        self._next_ping: int = 0  # When to ping next, in monotonic nanoseconds.
+
+    @property
+    def closed(self) -> bool:
+        """Whether the connection is closed.
+
+        A closed connection won't receive any packets and will silently swallow any sent packets.
+        Open a new connection with ``_ConnectionManager.open(host,port)`` instead of reopening it.
+        """
+        return self._manager is None
+
+    def _transmit(self, data: bytes):
+        """Send an encoded packet right away, dropping it if the socket buffer is full."""
+        try:
+            if self._manager.shared_socket:
+                self._socket.sendto(data, self._address)
+            else:
+                self._socket.send(data)
+        except BlockingIOError:
+            self._manager.send_drops += 1
+        except OSError:
+            # A connected socket reports an unreachable server on the next send, which UDP doesn't care about.
+            pass
+
+    def close(self):
+        """Close the connection, sending ``leave_packet`` first if set.
+
+        Does nothing if the connection is already closed.
+        """
+        if self.closed:
+            return
+        if self.leave_packet is not None:
+            self._transmit(self._encode(self.leave_packet))
+        self._manager._forget(self)
+        self._manager = None
+        self._address = None, None
+        self._in_queue.clear()
+        self._latest.clear()
+        if self._cancel_scope is not None:
+            # The receive task closes the socket once it stops.
+            self._cancel_scope.cancel()
+
+
+class _ConnectionManager:
+    """Runs many connections to servers on one event loop, for bots, relays and load tests.
+
+    Connections are opened with ``_ConnectionManager.open(host,port)`` from inside ``_ConnectionManager.run``,
+    and behave like ``_Connection`` otherwise. Each connection only costs one task receiving on its socket,
+    or none with ``_ConnectionManager.shared_socket``, since sending happens straight away
+    and one task resends and pings for all of them.
+    """
+    def __init__(self):
+        # Public attributes.
+        # Whether the connections share one socket, and are told apart by the address packets come from.
+        # This needs a different remote address for every connection, since a server would see them as one client.
+        self.shared_socket: bool = False
+        self.timer_interval: float = 0.05  # Seconds between checks for reliable packets to resend and pings to send.
+        self.connections: set[_ManagedConnection] = set()  # The open connections.
+        self.send_drops: int = 0  # Packets dropped because a socket's send buffer was full.
+        self.strays: int = 0  # Packets received on the shared socket from an address without a connection.
+
+        # Private variables.
+        self._socket: Optional[socket.socket] = None  # The shared socket.
+        self._by_address: dict[tuple[str, int], _ManagedConnection] = {}  # Connections on the shared socket.
+        self._task_group: Optional[TaskGroup] = None
+        # Reference to the cancel scope of the task group to allow shutdown.
+        self._cancel_scope: Optional[CancelScope] = None
+
+    async def open(self, host: str, port: int) -> _ManagedConnection:
+        """Open a new connection to a remote address. Must be called while running.
+
+        The connection is ready to send straight away, as UDP has no handshake.
+        Raises ``ValueError`` with ``shared_socket`` if there already is a connection to the address.
+        """
+        # The shared socket only speaks IPv4, and its packets are matched to connections by numeric address.
+        family = socket.AF_INET if self.shared_socket else 0
+        family, _, _, _, address = (await anyio.getaddrinfo(host, port, family=family, type=socket.SOCK_DGRAM))[0]
+        address = address[:2]
+        if self.shared_socket:
+            if address in self._by_address:
+                raise ValueError(f"already connected to {address[0]}:{address[1]} through the shared socket")
+            connection = _ManagedConnection(self, address, self._socket)
+            self._by_address[address] = connection
+        else:
+            raw_socket = socket.socket(family, socket.SOCK_DGRAM)
+            raw_socket.setblocking(False)
+            raw_socket.connect(address)
+            connection = _ManagedConnection(self, address, raw_socket)
+            self._task_group.start_soon(self._recv_loop, raw_socket, connection, name="Receive Loop")  # noqa
+        self.connections.add(connection)
+        return connection
+
+    def _forget(self, connection: _ManagedConnection):
+        """Stop running a closed connection."""
+        self.connections.discard(connection)
+        self._by_address.pop(connection.address, None)
+
+    async def _recv_loop(self, raw_socket: socket.socket, connection: Optional[_ManagedConnection]):
+        """The task responsible for receiving packets on a socket, for ``connection`` or the shared socket."""
+        with anyio.CancelScope() as scope:
+            if connection is not None:
+                connection._cancel_scope = scope
+            try:
+                # The connection may have been closed before this task started.
+                while connection is None or not connection.closed:
+                    await anyio.wait_socket_readable(raw_socket)
+                    # Handle everything that arrived before waiting again.
+                    while True:
+                        try:
+                            packet, address = raw_socket.recvfrom(65536)
+                        except BlockingIOError:
+                            break
+                        except OSError:
+                            # An unreachable server, reported by the connected socket.
+                            continue
+                        target = connection if connection is not None else self._by_address.get(address[:2])
+                        if target is None:
+                            self.strays += 1
+                        else:
+                            target._receive(packet)
+            finally:
+                raw_socket.close()
+
+    async def _timer_loop(self):
+        """The task responsible for resending reliable packets and pinging, for every connection."""
+        while True:
+            await anyio.sleep(self.timer_interval)
+            now = time.monotonic_ns()
+            # Sending can't close a connection, so the connections are safe to iterate over.
+            for connection in self.connections:
+                if connection.peer.pending and connection.peer.next_deadline() <= now:
+                    connection._send_due()
+                if connection.ping_interval is not None and connection._next_ping <= now:
+                    connection._next_ping = now + int(connection.ping_interval * 1_000_000_000)
+                    connection.send({"event": Event.PING, "time": now})
+
+    def run(self, coroutine: Callable[..., Awaitable], *args):
+        """Run ``coroutine`` in a network aware context.
+
+        This function blocks until ``_ConnectionManager.shutdown()`` is called from ``coroutine``.
+        """
+        # Enter the async loop.
+        anyio.run(self.run_async, coroutine, *args)  # noqa
+
+    async def run_async(self, coroutine: Callable[..., Awaitable], *args):
+        """Like ``_ConnectionManager.run``, but runs inside an event loop that is already running.
+
+        Every connection still open when it returns is closed.
+        """
+        async with anyio.create_task_group() as tg:
+            # Keep track of the cancel scope for easy shutdown later.
+            self._task_group = tg
+            self._cancel_scope = tg.cancel_scope
+            if self.shared_socket:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._socket.setblocking(False)
+                self._socket.bind(("0.0.0.0", 0))
+                tg.start_soon(self._recv_loop, self._socket, None, name="Receive Loop")  # noqa
+            tg.start_soon(self._timer_loop, name="Timer Loop")  # noqa
+            tg.start_soon(coroutine, *args, name="Application Loop")
+        # Clean up the connections left open by an error, whose sockets are closed already.
+        for connection in list(self.connections):
+            connection.close()
+        self._socket = None
+        self._task_group = None
+
+    def shutdown(self):
+        """Terminate the network processes and cause ``_ConnectionManager.run`` to return.
+
+        Closes every open connection, which lets the servers know they left.
+        This function does nothing if the manager isn't running.
+        """
+        if self._cancel_scope:
+            for connection in list(self.connections):
+                connection.close()
+            self._cancel_scope.cancel()
+            self._cancel_scope = None
+
+    @property
+    def running(self) -> bool:
+        """Whether the manager is running."""
+        return self._cancel_scope is not None
+
+
 # Grant outside access to the connection.
 connection = _Connection()
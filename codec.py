@@ -0,0 +1,229 @@
+import json
+import re
+import struct
+
+# Typing imports.
+from typing import Any, Callable, NamedTuple, Optional
+
+from settings import Event
+
+
+class Codec(NamedTuple):
+    """A pair of functions turning packets into bytes and back.
+
+    Use one on a server or connection with ``use_codec(codec)``.
+
+    ``encode_players`` and ``join_players`` build update packets out of separately encoded fragments.
+    ``encode_players`` encodes a dictionary of player dictionaries into a fragment,
+    and ``join_players`` joins a list of fragments and their player counts into a complete update packet.
+
+    ``peek`` cheaply reads the event and tick of an encoded packet without decoding the rest of it.
+    The tick is ``None`` if the packet doesn't have one.
+    """
+    encode: Callable[[Any], bytes]
+    decode: Callable[[bytes], Any]
+    encode_players: Callable[[dict], bytes]
+    join_players: Callable[[list[tuple[bytes, int]]], bytes]
+    peek: Callable[[bytes], tuple[int, Optional[int]]]
+
+
+def _join_json_players(fragments: list[tuple[bytes, int]]) -> bytes:
+    players = b", ".join(fragment for fragment, count in fragments if count)
+    return b'{"event": %d, "player_dicts": {%b}}' % (Event.UPDATE, players)
+
+
+# Top level keys of a JSON packet. Quotes inside strings are escaped, so these can't match inside a name.
+_JSON_EVENT = re.compile(rb'(?:{|, )"event": (\d+)')
+_JSON_TICK = re.compile(rb'(?:{|, )"tick": (\d+)')
+
+
+def _peek_json(data: bytes) -> tuple[int, Optional[int]]:
+    tick = _JSON_TICK.search(data)
+    return int(_JSON_EVENT.search(data)[1]), int(tick[1]) if tick else None
+
+
+# The JSON codec sends packets as readable text.
+# Dictionary keys always come back as strings, so integer player ids must be converted back with ``int``.
+JSON = Codec(
+    lambda x: bytes(json.dumps(x), "utf8"),
+    lambda x: json.loads(x),
+    lambda x: bytes(json.dumps(x)[1:-1], "utf8"),  # Leave out the braces, so fragments can be joined.
+    _join_json_players,
+    _peek_json,
+)
+
+
+# The binary codec packs each event into a fixed layout, starting with the event number as a byte.
+# Everything is little-endian, positions are 32-bit floats, and names are UTF-8 with a length byte in front.
+_EVENT = struct.Struct("<B")
+_NAME_LENGTH = struct.Struct("<B")
+_JOINED = struct.Struct("<BIff")  # Event, player id, position.
+_MOVE = struct.Struct("<BIff")  # Event, movement number, position.
+_ACK = struct.Struct("<BI")  # Event, tick.
+_INPUT = struct.Struct("<BIB")  # Event, movement number, keys.
+_PING = struct.Struct("<BQ")  # Event, time sent.
+_PONG = struct.Struct("<BQQ")  # Event, time the ping was sent, time the ping was held before answering.
+_UPDATE = struct.Struct("<BBIIH")  # Event, flags, tick, baseline, number of players.
+_PLAYER = struct.Struct("<IB")  # Player id, flags.
+_POSITION = struct.Struct("<ff")
+_SEQ = struct.Struct("<I")
+
+# Flags describing which optional parts of an update are present.
+_HAS_TICK = 1
+_HAS_BASELINE = 2
+# Flags describing which parts of a player are present in an update.
+_HAS_NAME = 1
+_HAS_POSITION = 2
+_REMOVED = 4
+_HAS_SEQ = 8
+
+
+def _encode_name(name: str) -> bytes:
+    data = bytes(name, "utf8")[:255]
+    return _NAME_LENGTH.pack(len(data)) + data
+
+
+def _decode_name(data: bytes, offset: int) -> tuple[str, int]:
+    """Decode a name starting at ``offset``, returning it with the offset just past it."""
+    length = data[offset]
+    offset += 1
+    return str(data[offset:offset + length], "utf8", "ignore"), offset + length
+
+
+def _encode_update(packet: dict) -> bytes:
+    # Updates may be keyframes or deltas made by snapshot.History, which can leave out anything that didn't change.
+    tick = packet.get("tick")
+    baseline = packet.get("baseline")
+    flags = (_HAS_TICK if tick is not None else 0) | (_HAS_BASELINE if baseline is not None else 0)
+    player_dicts = packet.get("player_dicts", {})
+    return _UPDATE.pack(Event.UPDATE, flags, tick or 0, baseline or 0, len(player_dicts)) + _encode_players(player_dicts)
+
+
+def _encode_players(player_dicts: dict) -> bytes:
+    parts = []
+    for player_id, attrs in player_dicts.items():
+        if attrs is None:
+            # The player was removed since the baseline.
+            parts.append(_PLAYER.pack(player_id, _REMOVED))
+            continue
+        player_flags = ((_HAS_NAME if "name" in attrs else 0) | (_HAS_POSITION if "position" in attrs else 0)
+                        | (_HAS_SEQ if "seq" in attrs else 0))
+        parts.append(_PLAYER.pack(player_id, player_flags))
+        if "position" in attrs:
+            parts.append(_POSITION.pack(*attrs["position"]))
+        if "seq" in attrs:
+            parts.append(_SEQ.pack(attrs["seq"]))
+        if "name" in attrs:
+            parts.append(_encode_name(attrs["name"]))
+    return b"".join(parts)
+
+
+def _join_binary_players(fragments: list[tuple[bytes, int]]) -> bytes:
+    # A single loop, since this runs for every neighbourhood of players with interest management.
+    parts = [b""]
+    count = 0
+    for fragment, fragment_count in fragments:
+        parts.append(fragment)
+        count += fragment_count
+    parts[0] = _UPDATE.pack(Event.UPDATE, 0, 0, 0, count)
+    return b"".join(parts)
+
+
+def _decode_update(data: bytes) -> dict:
+    _, flags, tick, baseline, count = _UPDATE.unpack_from(data)
+    offset = _UPDATE.size
+    player_dicts = {}
+    for _ in range(count):
+        player_id, player_flags = _PLAYER.unpack_from(data, offset)
+        offset += _PLAYER.size
+        if player_flags & _REMOVED:
+            player_dicts[player_id] = None
+            continue
+        attrs = player_dicts[player_id] = {}
+        if player_flags & _HAS_POSITION:
+            attrs["position"] = list(_POSITION.unpack_from(data, offset))
+            offset += _POSITION.size
+        if player_flags & _HAS_SEQ:
+            attrs["seq"] = _SEQ.unpack_from(data, offset)[0]
+            offset += _SEQ.size
+        if player_flags & _HAS_NAME:
+            attrs["name"], offset = _decode_name(data, offset)
+    packet = {"event": Event.UPDATE, "player_dicts": player_dicts}
+    if flags & _HAS_TICK:
+        packet["tick"] = tick
+        packet["baseline"] = baseline if flags & _HAS_BASELINE else None
+    return packet
+
+
+# Functions encoding each event, which receive the whole packet.
+_ENCODERS: dict[int, Callable[[dict], bytes]] = {
+    Event.JOIN: lambda packet: _EVENT.pack(Event.JOIN) + _encode_name(packet["name"]),
+    Event.JOINED: lambda packet: _JOINED.pack(Event.JOINED, packet["id"], *packet["position"]),
+    Event.UPDATE: _encode_update,
+    Event.MOVE: lambda packet: _MOVE.pack(Event.MOVE, packet["seq"], *packet["position"]),
+    Event.ACK: lambda packet: _ACK.pack(Event.ACK, packet["tick"]),
+    Event.INPUT: lambda packet: _INPUT.pack(Event.INPUT, packet["seq"], packet["keys"]),
+    Event.LEAVE: lambda packet: _EVENT.pack(Event.LEAVE),
+    Event.PING: lambda packet: _PING.pack(Event.PING, packet["time"]),
+    Event.PONG: lambda packet: _PONG.pack(Event.PONG, packet["time"], packet["hold"]),
+}
+
+
+def _decode_joined(data: bytes) -> dict:
+    _, player_id, x, y = _JOINED.unpack(data)
+    return {"event": Event.JOINED, "id": player_id, "position": [x, y]}
+
+
+def _decode_move(data: bytes) -> dict:
+    _, seq, x, y = _MOVE.unpack(data)
+    return {"event": Event.MOVE, "seq": seq, "position": [x, y]}
+
+
+def _decode_input(data: bytes) -> dict:
+    _, seq, keys = _INPUT.unpack(data)
+    return {"event": Event.INPUT, "seq": seq, "keys": keys}
+
+
+def _decode_pong(data: bytes) -> dict:
+    _, sent, hold = _PONG.unpack(data)
+    return {"event": Event.PONG, "time": sent, "hold": hold}
+
+
+# Functions decoding each event, which receive the whole packet.
+_DECODERS: dict[int, Callable[[bytes], dict]] = {
+    Event.JOIN: lambda data: {"event": Event.JOIN, "name": _decode_name(data, 1)[0]},
+    Event.JOINED: _decode_joined,
+    Event.UPDATE: _decode_update,
+    Event.MOVE: _decode_move,
+    Event.ACK: lambda data: {"event": Event.ACK, "tick": _ACK.unpack(data)[1]},
+    Event.INPUT: _decode_input,
+    Event.LEAVE: lambda data: {"event": Event.LEAVE},
+    Event.PING: lambda data: {"event": Event.PING, "time": _PING.unpack(data)[1]},
+    Event.PONG: _decode_pong,
+}
+
+
+def _encode_binary(packet: dict) -> bytes:
+    return _ENCODERS[packet["event"]](packet)
+
+
+def _decode_binary(data: bytes) -> dict:
+    return _DECODERS[data[0]](data)
+
+
+def _peek_binary(data: bytes) -> tuple[int, Optional[int]]:
+    if data[0] == Event.UPDATE:
+        _, flags, tick, _, _ = _UPDATE.unpack_from(data)
+        return Event.UPDATE, tick if flags & _HAS_TICK else None
+    return data[0], None
+
+
+# The binary codec only supports the events in ``settings.Event``, with the keys the game sends for them.
+# Player ids keep their integer type.
+BINARY = Codec(_encode_binary, _decode_binary, _encode_players, _join_binary_players, _peek_binary)
+
+# Maps codec names to codecs, for choosing one in the settings.
+CODECS = {
+    "json": JSON,
+    "binary": BINARY,
+}
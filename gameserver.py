@@ -1,46 +1,202 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import json
 import random
 
+import metrics
+import players
+import prediction
+import spatial
+from codec import CODECS
 from server import server
 
 from settings import *
 
 # This dictionary maps client addresses to player ids.
 client_ids: dict[tuple[str, int], int] = {}
+# This hands out player ids, reusing the ids of players that left.
+player_ids = players.IdAllocator()
+# This grid buckets player ids by position, so the players near a point can be found quickly.
+# It is updated as players join and move, and wraps around the screen like their movement does.
+player_grid = spatial.Grid(INTEREST_CELL_SIZE, wrap=SCREEN_SIZE)
+# This dictionary maps player ids to the movement keys they are holding down.
+player_inputs: dict[int, int] = {}
+# When NumPy is installed, the players are kept in these arrays instead of the game state's player dictionaries,
+# and their movement is simulated for all of them at once.
+# The player dictionaries are then rebuilt from the arrays every tick, only to be encoded and sent.
+player_arrays = players.PlayerArrays() if players.AVAILABLE else None
+# This dictionary caches the encoded players of each grid cell for the current tick.
+cell_fragments: dict[tuple[int, int], tuple[bytes, int]] = {}
+# This dictionary caches the encoded update for the players in each grid cell for the current tick.
+cell_views: dict[tuple[int, int], bytes] = {}
 
 
 def spawn_point() -> tuple[int, int]:
-    """Generate a random point within the screen bounds for spawning players in."""
-    return random.randrange(SCREEN_SIZE[0]), random.randrange(SCREEN_SIZE[1])
+    """Generate a random point within the screen bounds for spawning players in.
 
+    Points overlapping other players are avoided, unless no free point is found after a few tries.
+    """
+    for _ in range(10):
+        point = random.randrange(SCREEN_SIZE[0]), random.randrange(SCREEN_SIZE[1])
+        if not player_grid.query_radius(point, PLAYER_RADIUS * 2):
+            break
+    return point
 
-def game_tick():
-    """This function reads in packets and updates clients and game state."""
+
+def latest_seq(player_id: int) -> int:
+    """Return the number of the latest movement of a player the server applied."""
+    if player_arrays is not None:
+        return int(player_arrays.seqs[player_id])
+    return server.game_state["player_dicts"][player_id].get("seq", 0)
+
+
+def interest_view(address: tuple[str, int]) -> bytes:
+    """Build the encoded game state update for a client, only holding the players near its own player.
+
+    Players are included by grid cell, from every cell within ``INTEREST_RADIUS`` of the cell the client's player
+    is in, so some players beyond ``INTEREST_RADIUS`` are included too.
+    Each cell is only encoded once per tick, and its encoded fragment is shared by every client near it.
+    The update only depends on the client's cell, so clients in the same cell share the same update.
+    """
+    player_dicts = server.game_state["player_dicts"]
+    center = player_grid.cell(player_dicts[client_ids[address]]["position"])
+    view = cell_views.get(center)
+    if view is None:
+        codec = CODECS[CODEC]
+        fragments = []
+        for cell in player_grid.cells_near(center, INTEREST_RADIUS):
+            if cell not in cell_fragments:
+                cell_players = {player_id: player_dicts[player_id] for player_id in player_grid.cells[cell]}
+                cell_fragments[cell] = codec.encode_players(cell_players), len(cell_players)
+            fragments.append(cell_fragments[cell])
+        view = cell_views[center] = codec.join_players(fragments)
+    return view
+
+
+def game_tick(dt: float):
+    """This function reads in packets and updates clients and game state.
+
+    ``dt`` is the time in seconds since the previous tick.
+    """
+    # Players are about to move, so the encoded cells from the last tick are out of date.
+    cell_fragments.clear()
+    cell_views.clear()
     for packet, address in server:
-        # Get the player id of the address, setting it if unknown.
-        client_id = client_ids.setdefault(address, len(client_ids))
+        # Get the player id of the address, giving it a new one if it is joining.
+        if packet["event"] == Event.JOIN and address not in client_ids:
+            client_ids[address] = player_ids.allocate()
+        client_id = client_ids.get(address)
+        # Ignore packets from clients that haven't joined.
+        if client_id is None:
+            continue
         # The player wants to join the server.
         if packet["event"] == Event.JOIN:
             print(f"Client {client_id} \"{packet["name"]}\" joined from {address}")
             # Add the client to the server's list, so it receives game state updates.
             server.clients.add(address)
-            # Add a new player dictionary to the game state.
-            server.game_state["player_dicts"][client_id] = {"name": packet["name"], "position": (0, 0)}
-            # Send a reply to the client letting them know their id and position.
-            server.sendto(address, {"event": Event.JOINED, "id": client_id, "position": spawn_point()})
+            # Add the new player to the game.
+            position = list(spawn_point())
+            if player_arrays is not None:
+                player_arrays.add(client_id, packet["name"], position)
+            else:
+                server.game_state["player_dicts"][client_id] = {"name": packet["name"], "position": position}
+            player_grid.move(client_id, position)
+            # Send a reply to the client letting them know their id and position, resending it until it arrives.
+            server.sendto(address, {"event": Event.JOINED, "id": client_id, "position": position}, reliable=True)
         # The player has moved.
-        if packet["event"] == Event.MOVE:
-            # Record the new position in the game state.
-            server.game_state["player_dicts"][client_id]["position"] = packet["position"]
+        # Movements older than the latest one arrived out of order, and are ignored so the player isn't moved back.
+        # Packets sharing a movement number are told apart by the server, which drops the late ones.
+        if packet["event"] == Event.MOVE and not AUTHORITATIVE_MOVEMENT and packet["seq"] >= latest_seq(client_id):
+            # Record the new position in the game state,
+            # along with the number of the client's latest movement it includes for client-side prediction.
+            if player_arrays is not None:
+                player_arrays.set_position(client_id, packet["position"], packet["seq"])
+            else:
+                server.game_state["player_dicts"][client_id]["position"] = packet["position"]
+                server.game_state["player_dicts"][client_id]["seq"] = packet["seq"]
+            player_grid.move(client_id, packet["position"])
+        # The player changed the keys they are holding down. Older inputs are ignored like movements.
+        if packet["event"] == Event.INPUT and AUTHORITATIVE_MOVEMENT and packet["seq"] >= latest_seq(client_id):
+            # Record the number of the client's latest movement for client-side prediction too.
+            if player_arrays is not None:
+                player_arrays.set_input(client_id, packet["keys"], packet["seq"])
+            else:
+                player_inputs[client_id] = packet["keys"]
+                server.game_state["player_dicts"][client_id]["seq"] = packet["seq"]
+        # The player left the server.
+        if packet["event"] == Event.LEAVE:
+            server.disconnect(address, "leave")
+            continue
+        # The player received a game state snapshot.
+        if packet["event"] == Event.ACK:
+            # Send the player future game states as deltas against this snapshot.
+            server.acknowledge(address, packet["tick"])
+    move_players(dt)
+    if player_arrays is not None:
+        # Build the player dictionaries to send out from the arrays.
+        server.game_state["player_dicts"] = player_arrays.as_dicts()
+
+
+def remove_client(address: tuple[str, int]):
+    """Remove a client's player from the game, freeing its player id for reuse.
+
+    Called by the server whenever it disconnects a client.
+    """
+    client_id = client_ids.pop(address, None)
+    if client_id is None:
+        return
+    print(f"Client {client_id} disconnected from {address}")
+    if player_arrays is not None:
+        player_arrays.remove(client_id)
+    else:
+        server.game_state["player_dicts"].pop(client_id, None)
+        player_inputs.pop(client_id, None)
+    player_grid.remove(client_id)
+    player_ids.release(client_id)
+
+
+def move_players(dt: float):
+    """Move the players by the keys they are holding down, wrapping around the screen."""
+    if player_arrays is not None:
+        # Move everyone at once, then move the players that moved in the grid too.
+        for player_id in player_arrays.step(dt).tolist():
+            player_grid.move(player_id, player_arrays.positions[player_id].tolist())
+        return
+    player_dicts = server.game_state["player_dicts"]
+    for player_id, keys in player_inputs.items():
+        if keys:
+            position = prediction.apply_movement(player_dicts[player_id]["position"], prediction.input_movement(keys, dt))
+            player_dicts[player_id]["position"] = position
+            player_grid.move(player_id, position)
 
 
 if __name__ == '__main__':
-    # Set up the server to use json as a codec.
-    server.encode = lambda x: bytes(json.dumps(x), "utf8")
-    server.decode = lambda x: json.loads(x)
+    # Set up the server to use the codec shared with the clients.
+    server.use_codec(CODECS[CODEC])
+    # Choose how the server drives its socket.
+    server.backend = SERVER_BACKEND
+    # Number packets, so duplicates can be dropped and losses counted.
+    server.sequence_header = SEQUENCE_HEADER
+    # Drop movements that arrive after newer ones, which would move players back.
+    # Releasing the keys doesn't make a new movement, so its input shares the number of the previous one.
+    server.latest_only = {Event.MOVE, Event.INPUT}
+    # Measure the round trip time to every client.
+    server.ping_interval = PING_INTERVAL
+    # Record where the tick time goes, and serve it on the admin port.
+    if ADMIN_PORT is not None:
+        server.metrics = metrics.Metrics()
+        server.admin_port = ADMIN_PORT
+    # Disconnect clients that left or went quiet.
+    server.client_timeout = CLIENT_TIMEOUT
+    server.disconnect_func = remove_client
+    # Tick the server at a fixed rate.
+    server.tick_rate = TICK_RATE
+    # Only send clients what changed since the last game state they received.
+    server.delta_snapshots = True
+    server.snapshot_history = SNAPSHOT_HISTORY
+    # Only send clients the players near them.
+    if INTEREST_RADIUS is not None:
+        server.view_func = interest_view
     # Give the server an initial game state.
     server.game_state = INITIAL_GAME_STATE
     print(f"Server started on {HOST}:{PORT}")
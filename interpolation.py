@@ -0,0 +1,94 @@
+import bisect
+from collections import deque
+
+# Typing imports.
+from typing import Hashable, Optional
+
+from settings import SCREEN_SIZE
+
+
+def _wrapped_difference(start: float, end: float, size: float) -> float:
+    """The shortest signed distance from ``start`` to ``end`` on an axis that wraps around at ``size``."""
+    return (end - start + size / 2) % size - size / 2
+
+
+def _lerp(start: tuple[float, float], end: tuple[float, float], t: float) -> tuple[float, float]:
+    """Interpolate between two positions, or extrapolate past ``end`` if ``t`` is above 1.
+
+    Positions wrap around the screen, so players crossing an edge move across it instead of across the screen.
+    """
+    return (
+        (start[0] + _wrapped_difference(start[0], end[0], SCREEN_SIZE[0]) * t) % SCREEN_SIZE[0],
+        (start[1] + _wrapped_difference(start[1], end[1], SCREEN_SIZE[1]) * t) % SCREEN_SIZE[1],
+    )
+
+
+class SnapshotBuffer:
+    """A buffer of timestamped entity positions, for rendering remote entities smoothly.
+
+    Entities are rendered ``delay`` seconds in the past, interpolating between the two snapshots around that time,
+    so they move smoothly no matter how often or how evenly snapshots arrive.
+    If no newer snapshot has arrived in time, entities keep moving at their last velocity
+    for up to ``max_extrapolation`` seconds, and then stop.
+    """
+    def __init__(self, delay: float = 0.1, max_extrapolation: float = 0.25, size: int = 32):
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+        self._times: deque[float] = deque(maxlen=size)  # When each snapshot was taken, from oldest to newest.
+        self._snapshots: deque[dict[Hashable, tuple[float, float]]] = deque(maxlen=size)  # Positions by entity.
+
+    def add(self, timestamp: float, positions: dict[Hashable, tuple[float, float]]):
+        """Add a snapshot of entity positions taken at ``timestamp`` seconds.
+
+        Snapshots that aren't newer than the newest snapshot in the buffer are ignored.
+        """
+        if self._times and timestamp <= self._times[-1]:
+            return
+        self._times.append(timestamp)
+        self._snapshots.append(positions)
+
+    def sample(self, now: float) -> dict[Hashable, tuple[float, float]]:
+        """Return the positions of the entities to render at ``now`` seconds."""
+        if not self._snapshots:
+            return {}
+        render_time = now - self.delay
+        # Find the first snapshot newer than the render time.
+        index = bisect.bisect_right(self._times, render_time)
+        if index == 0:
+            # The render time is before every snapshot.
+            return dict(self._snapshots[0])
+        if index == len(self._snapshots):
+            # The render time is past the newest snapshot, so extrapolate from the last two.
+            if index == 1:
+                return dict(self._snapshots[0])
+            index -= 1
+            render_time = min(render_time, self._times[index] + self.max_extrapolation)
+        start_time, end_time = self._times[index - 1], self._times[index]
+        start, end = self._snapshots[index - 1], self._snapshots[index]
+        t = (render_time - start_time) / (end_time - start_time) if end_time > start_time else 1.0
+        # Entities only in the newer snapshot appear there, and entities missing from it are gone.
+        return {key: _lerp(start[key], position, t) if key in start else position for key, position in end.items()}
+
+
+class TickClock:
+    """Converts the server's tick numbers to the local clock, to time snapshots by when the server took them.
+
+    Arrival times are skewed by network jitter, so evenly spaced snapshots would arrive unevenly.
+    Instead, every snapshot is timed as if it arrived with the smallest delay seen,
+    by offsetting the server time of its tick to the local clock.
+    The offset creeps up by ``drift`` seconds per snapshot, so it recovers when the delay grows for good,
+    or when the server falls behind its tick rate.
+    """
+    def __init__(self, tick_rate: int, drift: float = 0.001):
+        self.tick_rate = tick_rate
+        self.drift = drift
+        self.offset: Optional[float] = None  # Seconds from the server time of a tick to the local clock.
+
+    def timestamp(self, tick: int, arrival: float) -> float:
+        """Return the local time a snapshot taken on ``tick`` was sent at, given it arrived at ``arrival``."""
+        server_time = tick / self.tick_rate
+        if self.offset is None:
+            self.offset = arrival - server_time
+        else:
+            self.offset = min(arrival - server_time, self.offset + self.drift)
+        return server_time + self.offset
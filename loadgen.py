@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+"""Headless load generator for the game server.
+
+Runs many simulated clients in one process, each joining the server and then walking around randomly,
+and reports the latency, throughput and packet loss they see.
+The clients share one event loop through a ``client._ConnectionManager``.
+Run ``python loadgen.py --help`` for the options.
+
+Start the server first with ``python gameserver.py``. If it serves metrics on an admin port (``ADMIN_PORT``),
+the report also includes the round trip times and tick phase timings the server measured.
+"""
+
+import argparse
+import multiprocessing
+import random
+import re
+import time
+import urllib.request
+
+# Typing imports.
+from typing import Optional
+
+import anyio
+
+import prediction
+import snapshot
+from client import _ConnectionManager, _ManagedConnection
+from codec import CODECS
+
+from settings import *
+
+
+def percentiles(samples: list[float]) -> str:
+    """Describe samples in milliseconds with their median, 90th and 99th percentiles and maximum."""
+    if not samples:
+        return "no samples"
+    samples = sorted(samples)
+    p50, p90, p99 = (samples[min(len(samples) - 1, int(len(samples) * p))] for p in (0.5, 0.9, 0.99))
+    return f"p50 {p50:.2f} ms  p90 {p90:.2f} ms  p99 {p99:.2f} ms  max {samples[-1]:.2f} ms"
+
+
+class SimulatedClient:
+    """One headless player: joins the server, then changes direction at random and sends its input at a fixed rate.
+
+    Sends MOVE packets with its new position, or INPUT packets with its keys with ``AUTHORITATIVE_MOVEMENT``.
+    """
+    def __init__(self, name: str, rate: float):
+        self.connection: Optional[_ManagedConnection] = None  # Opened once playing.
+        self.name = name
+        self.rate = rate  # Packets sent per second.
+        self.player_id = None
+        self.joined_ns = None  # How long joining took.
+        self.sent = 0  # Number of MOVE or INPUT packets sent.
+        self.updates = 0  # Number of game state updates received.
+        # Milliseconds from sending an input until a game state including it arrived.
+        self.input_latencies: list[float] = []
+        self.rtts: list[float] = []  # Milliseconds of each ping measurement.
+        # Milliseconds each step started late, which shows when the load generator itself can't keep up.
+        self.lags: list[float] = []
+        self._sent_ns: dict[int, int] = {}  # When each movement was sent, by its number.
+
+    async def play(self, manager: _ConnectionManager, host: str, port: int, duration: float):
+        """Join the server and send input for ``duration`` seconds, then leave."""
+        connection = self.connection = await manager.open(host, port)
+        connection.use_codec(CODECS[CODEC])
+        connection.leave_packet = {"event": Event.LEAVE}
+        connection.sequence_header = SEQUENCE_HEADER
+        connection.ping_interval = PING_INTERVAL
+        connection.latest_only = {Event.UPDATE}
+        history = snapshot.History(SNAPSHOT_HISTORY)
+        seq = 0
+        keys = 0
+        position = [0.0, 0.0]
+        pings = 0
+        start = time.monotonic_ns()
+        connection.send({"event": Event.JOIN, "name": self.name}, reliable=True)
+        period = int(1_000_000_000 / self.rate)
+        deadline = time.monotonic_ns()
+        end = deadline + int(duration * 1_000_000_000)
+        while deadline < end:
+            # Step at a fixed rate, skipping steps instead of bunching them up when running late.
+            deadline += period
+            now = time.monotonic_ns()
+            if now < deadline:
+                await anyio.sleep((deadline - now) / 1_000_000_000)
+            else:
+                deadline = now
+                await anyio.sleep(0)
+            self.lags.append((time.monotonic_ns() - deadline) / 1_000_000)
+            for packet in connection:
+                if packet["event"] == Event.JOINED:
+                    self.player_id = packet["id"]
+                    self.joined_ns = time.monotonic_ns() - start
+                    position = packet["position"]
+                elif packet["event"] == Event.UPDATE and self.player_id is not None:
+                    self._receive_update(history.receive(packet))
+                    if "tick" in packet:
+                        connection.send({"event": Event.ACK, "tick": packet["tick"]})
+            if connection.round_trip.samples > pings:
+                pings = connection.round_trip.samples
+                self.rtts.append(connection.round_trip.latest_ns / 1_000_000)
+            if self.player_id is None:
+                continue
+            # Now and then, turn towards a random direction, or stop.
+            if random.random() < 0.1:
+                keys = random.choice([0, Input.RIGHT, Input.LEFT, Input.UP, Input.DOWN, Input.RIGHT | Input.UP])
+            seq += 1
+            self._sent_ns[seq] = time.monotonic_ns()
+            if AUTHORITATIVE_MOVEMENT:
+                connection.send({"event": Event.INPUT, "seq": seq, "keys": keys})
+            else:
+                position = prediction.apply_movement(position, prediction.input_movement(keys, 1 / self.rate))
+                connection.send({"event": Event.MOVE, "seq": seq, "position": position})
+            self.sent += 1
+        # Let the last packets go out before leaving.
+        await anyio.sleep(0.1)
+        connection.close()
+
+    def _receive_update(self, game_state: Optional[dict]):
+        """Measure how long the newest movement the server applied took to come back."""
+        if game_state is None:
+            return
+        self.updates += 1
+        player_dicts = game_state["player_dicts"]
+        # The JSON codec turns player ids into strings.
+        attrs = player_dicts.get(self.player_id) or player_dicts.get(str(self.player_id))
+        if attrs is None or attrs.get("seq") not in self._sent_ns:
+            return
+        seq = attrs["seq"]
+        self.input_latencies.append((time.monotonic_ns() - self._sent_ns[seq]) / 1_000_000)
+        # Older movements will never be measured now.
+        for old in [old for old in self._sent_ns if old <= seq]:
+            del self._sent_ns[old]
+
+
+def scrape(admin_port: int) -> Optional[dict[str, float]]:
+    """Read the server's metrics from its admin port, or ``None`` if it can't be reached."""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{admin_port}/metrics", timeout=2) as response:
+            text = response.read().decode()
+    except OSError:
+        return None
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def histogram_percentiles(before: dict[str, float], after: dict[str, float], name: str, labels: str = "") -> str:
+    """Describe what a histogram of the server's metrics recorded between two scrapes, like ``percentiles``.
+
+    Percentiles are estimated by interpolating within the buckets, like Prometheus does.
+    """
+    buckets = []
+    pattern = re.compile(re.escape(f"{name}_bucket{{{labels}le=") + r'"([^"]+)"}')
+    for key, value in after.items():
+        match = pattern.fullmatch(key)
+        if match:
+            buckets.append((float(match[1]), value - before.get(key, 0)))
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return "no samples"
+    results = []
+    for p in (0.5, 0.9, 0.99):
+        rank = p * total
+        lower_bound = lower_count = 0
+        for bound, count in buckets:
+            if count >= rank:
+                if bound == float("inf"):
+                    results.append(f"p{int(p * 100)} > {lower_bound * 1000:.2f} ms")
+                else:
+                    fraction = (rank - lower_count) / (count - lower_count) if count > lower_count else 1
+                    results.append(f"p{int(p * 100)} {(lower_bound + (bound - lower_bound) * fraction) * 1000:.2f} ms")
+                break
+            lower_bound, lower_count = bound, count
+    return "  ".join(results)
+
+
+async def run(manager: _ConnectionManager, host: str, port: int, clients: list[SimulatedClient], duration: float,
+              ramp: float):
+    """Run every simulated client at once, starting them over ``ramp`` seconds."""
+    async with anyio.create_task_group() as tg:
+        for client in clients:
+            tg.start_soon(client.play, manager, host, port, duration)
+            await anyio.sleep(ramp / len(clients))
+    manager.shutdown()
+
+
+def run_clients(host: str, port: int, first: int, count: int, rate: float, duration: float, ramp: float) -> dict:
+    """Run ``count`` simulated clients in this process, and gather what they measured.
+
+    Clients are numbered from ``first``, so that clients run by different processes get different names.
+    """
+    clients = [SimulatedClient(f"Bot {i}", rate) for i in range(first, first + count)]
+    manager = _ConnectionManager()
+    manager.run(run, manager, host, port, clients, duration, ramp)
+    peers = [client.connection.peer for client in clients]
+    return {
+        "clients": len(clients),
+        "joined": [client.joined_ns / 1_000_000 for client in clients if client.joined_ns is not None],
+        "sent": sum(client.sent for client in clients),
+        "updates": sum(client.updates for client in clients),
+        "received": sum(peer.received for peer in peers),
+        "lost": sum(peer.lost for peer in peers),
+        "reordered": sum(peer.reordered for peer in peers),
+        "duplicates": sum(peer.duplicates for peer in peers),
+        "input_latencies": [x for client in clients for x in client.input_latencies],
+        "rtts": [x for client in clients for x in client.rtts],
+        "lags": [x for client in clients for x in client.lags],
+        "send_drops": manager.send_drops,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the game server with many simulated clients.")
+    parser.add_argument("--host", default=HOST, help="server host (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT, help="server port (default: %(default)s)")
+    parser.add_argument("--clients", type=int, default=100, help="number of simulated clients (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=30, help="packets each client sends per second "
+                                                                "(default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds each client plays (default: %(default)s)")
+    parser.add_argument("--ramp", type=float, default=1, help="seconds over which clients join (default: %(default)s)")
+    parser.add_argument("--admin-port", type=int, default=ADMIN_PORT,
+                        help="the server's admin port, to report what it measured (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes to spread the clients over, for when one can't keep up "
+                             "(default: %(default)s)")
+    args = parser.parse_args()
+
+    before = scrape(args.admin_port) if args.admin_port is not None else None
+    print(f"Running {args.clients} clients at {args.rate:g} packets per second for {args.duration:g} seconds "
+          f"against {args.host}:{args.port} from {args.processes} process(es)")
+    # Split the clients evenly between the processes.
+    shares = [(args.host, args.port, args.clients * i // args.processes,
+               args.clients * (i + 1) // args.processes - args.clients * i // args.processes,
+               args.rate, args.duration, args.ramp) for i in range(args.processes)]
+    start = time.monotonic()
+    if args.processes == 1:
+        parts = [run_clients(*shares[0])]
+    else:
+        with multiprocessing.Pool(args.processes) as pool:
+            parts = pool.starmap(run_clients, shares)
+    elapsed = time.monotonic() - start
+    after = scrape(args.admin_port) if before is not None else None
+    # Merge what every process measured.
+    results = {key: sum((part[key] for part in parts), [] if isinstance(parts[0][key], list) else 0)
+               for key in parts[0]}
+
+    sent = results["sent"]
+    received = results["received"]
+    lost = results["lost"]
+    print(f"{'joined':<18} {len(results['joined'])}/{results['clients']}  {percentiles(results['joined'])}")
+    print(f"{'sent':<18} {sent} inputs ({sent / elapsed:.0f}/s), {results['send_drops']} dropped by full buffers")
+    print(f"{'received':<18} {received} packets ({received / elapsed:.0f}/s), {results['updates']} game states")
+    if SEQUENCE_HEADER:
+        print(f"{'downstream loss':<18} {lost / max(received + lost, 1):.2%} ({lost} packets), "
+              f"{results['reordered']} reordered, {results['duplicates']} duplicated")
+    print(f"{'input latency':<18} {percentiles(results['input_latencies'])}")
+    print(f"{'client ping':<18} {percentiles(results['rtts'])}")
+    print(f"{'generator lag':<18} {percentiles(results['lags'])}")
+    lags = sorted(results["lags"])
+    # Steps starting more than half a period late means the simulated clients aren't getting the time they need.
+    if lags and lags[int(len(lags) * 0.9)] > 500 / args.rate:
+        print("The load generator is falling behind, so its latencies are inflated. Try more --processes.")
+    if after is None:
+        print("Server metrics unavailable, start the server with ADMIN_PORT set to see what it measured.")
+        return
+    event = "INPUT" if AUTHORITATIVE_MOVEMENT else "MOVE"
+    key = f'game_packets_total{{direction="in",event="{event}"}}'
+    server_inputs = after.get(key, 0) - before.get(key, 0)
+    # Assumes these clients are the only ones sending input.
+    print(f"{'upstream loss':<18} {1 - server_inputs / max(sent, 1):.2%} ({sent - server_inputs:.0f} packets)")
+    key = 'game_packets_total{direction="out",event="UPDATE"}'
+    print(f"{'server updates':<18} {(after.get(key, 0) - before.get(key, 0)) / elapsed:.0f}/s")
+    print(f"{'server ping':<18} {histogram_percentiles(before, after, 'game_client_rtt_seconds')}")
+    for phase in ("recv", "tick", "encode", "send"):
+        labels = f'phase="{phase}",'
+        print(f"{'server ' + phase:<18} {histogram_percentiles(before, after, 'game_tick_phase_seconds', labels)}")
+    key = "game_tick_overruns_total"
+    print(f"{'server overruns':<18} {after.get(key, 0) - before.get(key, 0):.0f}")
+
+
+if __name__ == '__main__':
+    main()
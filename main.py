@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import json
+import time
 
 import pygame as pg
 
+import interpolation
+import prediction
+import snapshot
 from client import connection
+from codec import CODECS
 
 from settings import *
 
-PLAYER_SPEED = 100
-
 
 async def game_loop():
     # Set up pygame variables.
@@ -23,13 +25,20 @@ async def game_loop():
     player_pos = [SCREEN_SIZE[0] // 2, SCREEN_SIZE[1] // 2]
     game_state = INITIAL_GAME_STATE
     player_id = None
+    # Recent game states, which the server sends deltas against.
+    history = snapshot.History(SNAPSHOT_HISTORY)
+    # Our movements the server hasn't applied yet, which are replayed on top of the positions it sends.
+    predictor = prediction.Predictor()
+    # Recent positions of the other players, which they are smoothly rendered in between.
+    interpolator = interpolation.SnapshotBuffer(INTERPOLATION_DELAY)
+    # Times snapshots by the server tick they were taken on, so network jitter doesn't make the players stutter.
+    tick_clock = interpolation.TickClock(TICK_RATE)
 
     # Wait until we are connected to the server.
-    while connection.closed:
-        await connection.pump()
+    await connection.wait_connected()
 
-    # Ask to join the server.
-    connection.send({"event": Event.JOIN, "name": username})
+    # Ask to join the server, resending the request until it arrives.
+    connection.send({"event": Event.JOIN, "name": username}, reliable=True)
 
     # Enter the main application loop.
     while True:
@@ -50,10 +59,29 @@ async def game_loop():
                 # Only handle this if we have a valid ID, and it is registered in the game state.
                 # Sometimes we receive packets out of order.
                 if player_id is not None:
-                    game_state = packet
-                    if player_id in game_state["player_dicts"]:
-                        # Get the new position of the player.
-                        player_pos = game_state["player_dicts"][player_id]["position"]
+                    # Rebuild the full game state from the delta the server sent.
+                    new_state = history.receive(packet)
+                    if new_state is None:
+                        # We no longer have the baseline, so wait for a keyframe.
+                        continue
+                    # The JSON codec turns player ids into strings, so turn them back into integers.
+                    game_state = {**new_state, "player_dicts": {
+                        int(pid): attrs for pid, attrs in new_state["player_dicts"].items()
+                    }}
+                    # Packets without a tick number are timed by when they arrived.
+                    timestamp = time.monotonic()
+                    if "tick" in packet:
+                        timestamp = tick_clock.timestamp(packet["tick"], timestamp)
+                    interpolator.add(timestamp, {
+                        pid: attrs["position"] for pid, attrs in game_state["player_dicts"].items()
+                    })
+                    # Let the server know we received this game state, so it can send deltas against it.
+                    if "tick" in packet:
+                        connection.send({"event": Event.ACK, "tick": packet["tick"]})
+                    attrs = game_state["player_dicts"].get(player_id)
+                    if attrs is not None and "seq" in attrs:
+                        # Get the new position of the player, with the movements the server hasn't seen yet.
+                        player_pos = predictor.reconcile(attrs["position"], attrs["seq"])
 
         # Handle pygame events.
         for event in pg.event.get():
@@ -63,32 +91,44 @@ async def game_loop():
                 if event.key == pg.K_ESCAPE:
                     connection.shutdown()  # Terminate connection to server immediately.
 
-        # Move the player in a frame-independent way, wrapping around the screen.
+        # Work out which movement keys are held down.
+        keys = 0
         if pg.key.get_pressed()[pg.K_RIGHT]:
-            player_pos[0] += PLAYER_SPEED * dt
-            player_pos[0] %= SCREEN_SIZE[0]
+            keys |= Input.RIGHT
         if pg.key.get_pressed()[pg.K_LEFT]:
-            player_pos[0] -= PLAYER_SPEED * dt
-            player_pos[0] %= SCREEN_SIZE[0]
+            keys |= Input.LEFT
         if pg.key.get_pressed()[pg.K_UP]:
-            player_pos[1] -= PLAYER_SPEED * dt
-            player_pos[1] %= SCREEN_SIZE[1]
+            keys |= Input.UP
         if pg.key.get_pressed()[pg.K_DOWN]:
-            player_pos[1] += PLAYER_SPEED * dt
-            player_pos[1] %= SCREEN_SIZE[1]
-
-        # Alert the server of our new position.
-        connection.send({"event": Event.MOVE, "position": player_pos})
+            keys |= Input.DOWN
+        if keys:
+            # Move the player right away in a frame-independent way, wrapping around the screen,
+            # and remember the movement for reconciliation.
+            movement = prediction.input_movement(keys, dt)
+            predictor.record(movement)
+            player_pos = prediction.apply_movement(player_pos, movement)
+
+        if AUTHORITATIVE_MOVEMENT:
+            # Alert the server of the keys we are holding down, and our latest movement.
+            connection.send({"event": Event.INPUT, "seq": predictor.seq, "keys": keys})
+        else:
+            # Alert the server of our new position, and which of our movements it includes.
+            connection.send({"event": Event.MOVE, "seq": predictor.seq, "position": player_pos})
 
         # Clear the screen for the next frame drawing.
         screen.fill((0, 0, 0))
 
         # Draw each player on the screen.
+        positions = interpolator.sample(time.monotonic())
         for pid, attrs in game_state["player_dicts"].items():
             # You are green, other players are cyan.
-            color = (0, 255, 0) if int(pid) == player_id else (0, 255, 255)
+            color = (0, 255, 0) if pid == player_id else (0, 255, 255)
             # Get the position of the current player.
-            pos = game_state["player_dicts"][pid]["position"]
+            # You are drawn where you predict to be, other players are drawn a little in the past.
+            if pid == player_id:
+                pos = player_pos
+            else:
+                pos = positions.get(pid, attrs["position"])
             # Draw the player to the screen.
             pg.draw.circle(screen, color, pos, PLAYER_RADIUS)
             # Render the username of the player on top of them.
@@ -102,9 +142,16 @@ async def game_loop():
         pg.display.flip()
 
 if __name__ == '__main__':
-    # Set up the connection to use json as a codec.
-    connection.encode = lambda x: bytes(json.dumps(x), "utf8")
-    connection.decode = lambda x: json.loads(x)
+    # Set up the connection to use the codec shared with the server.
+    connection.use_codec(CODECS[CODEC])
+    # Let the server know when we leave.
+    connection.leave_packet = {"event": Event.LEAVE}
+    # Number packets, so duplicates and out of order game states can be dropped.
+    connection.sequence_header = SEQUENCE_HEADER
+    # Measure the round trip time to the server.
+    connection.ping_interval = PING_INTERVAL
+    # Only decode the newest game state after a hitch, instead of every update that piled up.
+    connection.latest_only = {Event.UPDATE}
     # Get a username from the user.
     username = input("Username: ")
     # Initialize the graphics library.
@@ -0,0 +1,113 @@
+import bisect
+import time
+
+# Typing imports.
+from typing import Any, Optional
+
+from settings import Event
+
+# Upper bounds of the histogram buckets in nanoseconds, from 1 microsecond to 5 seconds.
+BUCKETS = [int(mantissa * 10 ** exponent) for exponent in range(3, 10) for mantissa in (1, 2.5, 5)]
+
+# The phases of a server tick that are timed.
+# "recv" is handling one received datagram, "tick" is the tick function,
+# "encode" is building the frame of packets, and "send" is sending the frame out.
+PHASES = ("recv", "tick", "encode", "send")
+
+
+class Histogram:
+    """Counts nanosecond durations in the fixed buckets of ``metrics.BUCKETS``."""
+    def __init__(self):
+        self.counts: list[int] = [0] * (len(BUCKETS) + 1)  # The last bucket holds everything too long for the rest.
+        self.total: int = 0  # The sum of every duration observed.
+        self.count: int = 0
+
+    def observe(self, duration: int):
+        self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        self.total += duration
+        self.count += 1
+
+
+def _event_name(event: Any) -> str:
+    """Name an event number for a label. Packets without a payload, which only acknowledge, have no event."""
+    if event is None:
+        return "NONE"
+    try:
+        return Event(event).name
+    except ValueError:
+        return str(event)
+
+
+def _histogram_lines(name: str, labels: str, histogram: Histogram) -> list[str]:
+    """Render the samples of a histogram in seconds. ``labels`` come before the bucket label, ending in a comma."""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}le="{bound / 1e9:g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {histogram.count}')
+    # The sum and count only have the other labels.
+    labels = f'{{{labels.rstrip(",")}}}' if labels else ""
+    lines.append(f'{name}_sum{labels} {histogram.total / 1e9}')
+    lines.append(f'{name}_count{labels} {histogram.count}')
+    return lines
+
+
+class Metrics:
+    """Server instrumentation: tick phase timings, packet and byte counters per event, and queue depths.
+
+    Set ``_Server.metrics`` to an instance to record them, and render them in the Prometheus text format
+    with ``Metrics.render``. While ``_Server.metrics`` is ``None`` nothing is recorded.
+    """
+    def __init__(self):
+        self.phases: dict[str, Histogram] = {phase: Histogram() for phase in PHASES}
+        self.rtt: Histogram = Histogram()  # Round trip times measured by pinging the clients.
+        # Datagrams and their bytes by direction ("in" or "out") and the event of their payload.
+        self.packets: dict[tuple[str, Any], int] = {}
+        self.bytes: dict[tuple[str, Any], int] = {}
+        self.in_queue_depth: int = 0  # Packets waiting for the tick function at the start of the last tick.
+        self.out_queue_depth: int = 0  # Packets queued by the tick function in the last tick.
+        self.started: float = time.time()  # When recording started, as a Unix timestamp.
+
+    def count(self, direction: str, event: Any, size: int, copies: int = 1):
+        """Count ``copies`` packets of an event going in ``direction``, each ``size`` bytes long."""
+        key = direction, event
+        self.packets[key] = self.packets.get(key, 0) + copies
+        self.bytes[key] = self.bytes.get(key, 0) + size * copies
+
+    def render(self, extra: Optional[dict[str, tuple[str, str, float]]] = None) -> str:
+        """Render the metrics in the Prometheus text format.
+
+        ``extra`` adds more metrics by name, with their type ("gauge" or "counter"), help text and value.
+        """
+        lines = [
+            "# HELP game_tick_phase_seconds Time spent in each phase of the server tick.",
+            "# TYPE game_tick_phase_seconds histogram",
+        ]
+        for phase, histogram in self.phases.items():
+            lines.extend(_histogram_lines("game_tick_phase_seconds", f'phase="{phase}",', histogram))
+        lines.append("# HELP game_client_rtt_seconds Round trip times to the clients, measured with pings.")
+        lines.append("# TYPE game_client_rtt_seconds histogram")
+        lines.extend(_histogram_lines("game_client_rtt_seconds", "", self.rtt))
+        counters_by_name = {
+            "game_packets_total": ("Packets received and sent by event.", self.packets),
+            "game_bytes_total": ("Datagram bytes received and sent by event.", self.bytes),
+        }
+        for name, (help_text, counters) in counters_by_name.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (direction, event), value in counters.items():
+                lines.append(f'{name}{{direction="{direction}",event="{_event_name(event)}"}} {value}')
+        others = {
+            "game_in_queue_depth": ("gauge", "Packets waiting for the tick function at the start of the last tick.",
+                                    self.in_queue_depth),
+            "game_out_queue_depth": ("gauge", "Packets queued by the tick function in the last tick.",
+                                     self.out_queue_depth),
+            "game_metrics_start_time_seconds": ("gauge", "When the metrics started recording.", self.started),
+        }
+        others.update(extra or {})
+        for name, (kind, help_text, value) in others.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,103 @@
+import ctypes
+import os
+import socket
+import struct
+import sys
+
+# Typing imports.
+from typing import Sequence
+
+# Sending many datagrams with a single sendmmsg system call, which is only available on Linux.
+# Check ``mmsg.AVAILABLE`` before calling ``mmsg.sendmmsg``.
+
+# The most messages the kernel accepts in one call.
+MAX_BATCH = 1024
+
+# The C structures passed to sendmmsg, packed with native alignment.
+# struct mmsghdr: name, name length, iovec array, iovec count, control, control length, flags, sent length.
+# It is packed in two parts, which are cached: the address fields, which stay the same for a client,
+# and the rest, which stays the same for every message sharing an iovec.
+_NAME = struct.Struct("@PI")
+# The rest starts with 4 bytes standing in for the name length, to align it like the full structure.
+# They are cut off when packing, leaving the padding after the name length.
+_REST = struct.Struct("@4xPNPNi4xI4x")
+# struct iovec: buffer, buffer length.
+_IOVEC = struct.Struct("@PN")
+
+_libc = ctypes.CDLL(None, use_errno=True) if sys.platform.startswith("linux") else None
+AVAILABLE = _libc is not None and hasattr(_libc, "sendmmsg")
+if AVAILABLE:
+    _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _libc.sendmmsg.restype = ctypes.c_int
+
+# Socket addresses as C structures with their packed ``_NAME`` fields,
+# which are cached because clients are sent to every tick.
+_sockaddrs: dict[tuple, tuple[ctypes.Array, bytes]] = {}
+_MAX_SOCKADDRS = 65536  # The cache is cleared between calls once it grows past this many addresses.
+
+
+def _sockaddr(address: tuple) -> tuple[ctypes.Array, bytes]:
+    """Return the address as a C socket address structure, and the ``_NAME`` fields of a message sent to it."""
+    sockaddr = _sockaddrs.get(address)
+    if sockaddr is None:
+        if ":" in address[0]:
+            # struct sockaddr_in6: family, port, flow info, address, scope id.
+            data = (struct.pack("=H", socket.AF_INET6) + struct.pack("!HI", address[1], 0)
+                    + socket.inet_pton(socket.AF_INET6, address[0]) + struct.pack("=I", 0))
+        else:
+            # struct sockaddr_in: family, port, address, padding.
+            data = struct.pack("=H", socket.AF_INET) + struct.pack("!H", address[1]) + socket.inet_aton(address[0])
+            data += bytes(8)
+        buffer = ctypes.create_string_buffer(data, len(data))
+        sockaddr = _sockaddrs[address] = buffer, _NAME.pack(ctypes.addressof(buffer), len(data))
+    return sockaddr
+
+
+def _address_of(buffer: bytearray) -> int:
+    """Return the memory address of a bytearray's contents."""
+    return ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+
+
+def sendmmsg(sock: socket.socket, datagrams: Sequence[tuple[bytes, tuple]]) -> int:
+    """Send a sequence of ``(data, address)`` pairs through a datagram socket in a single system call.
+
+    At most ``MAX_BATCH`` datagrams are sent, and the kernel may send fewer than were given.
+    Returns the number of datagrams sent.
+    Raises ``BlockingIOError`` if the socket is non-blocking and none could be sent without blocking.
+    """
+    count = min(len(datagrams), MAX_BATCH)
+    if len(_sockaddrs) >= _MAX_SOCKADDRS:
+        # Only evicted between calls, so no address is freed while a call uses it.
+        _sockaddrs.clear()
+    # Datagrams sharing the same bytes, like broadcasts, share one iovec.
+    iovec_indices: dict[int, int] = {}
+    buffers = []  # Also keeps the buffers alive until the call returns.
+    for index in range(count):
+        data = datagrams[index][0]
+        if id(data) not in iovec_indices:
+            iovec_indices[id(data)] = len(buffers)
+            buffers.append(data)
+    # Copying the distinct buffers into one block is cheaper than looking up where each of them is.
+    block = bytearray(b"".join(buffers))
+    block_address = _address_of(block) if block else 0
+    iovec_list = []
+    offset = 0
+    for data in buffers:
+        iovec_list.append(_IOVEC.pack(block_address + offset, len(data)))
+        offset += len(data)
+    iovecs = bytearray(b"".join(iovec_list))
+    iovecs_address = _address_of(iovecs)
+    # The part of the message after the address, by the id of the datagram's bytes.
+    rests = {key: _REST.pack(iovecs_address + index * _IOVEC.size, 1, 0, 0, 0, 0)[4:]
+             for key, index in iovec_indices.items()}
+    # Build a message for every datagram. The kernel writes the sent lengths into them, so they must be writable.
+    # The list keeps the socket addresses alive until the call returns.
+    sockaddrs = [_sockaddrs.get(address) or _sockaddr(address) for _, address in datagrams[:count]]
+    messages = bytearray(b"".join([sockaddr[1] + rests[id(datagrams[index][0])]
+                                   for index, sockaddr in enumerate(sockaddrs)]))
+    sent = _libc.sendmmsg(sock.fileno(), _address_of(messages), count, 0)
+    if sent < 0:
+        # OSError picks the matching subclass for the error number, like BlockingIOError for EAGAIN.
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return sent
@@ -0,0 +1,135 @@
+import heapq
+
+# NumPy is optional, check ``players.AVAILABLE`` before creating a ``PlayerArrays``.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Typing imports.
+from typing import Iterable
+
+from settings import SCREEN_SIZE, PLAYER_SPEED, Input
+
+AVAILABLE = np is not None
+
+
+class IdAllocator:
+    """Hands out small integer ids, reusing released ids before making new ones.
+
+    The lowest free id is always handed out first, which keeps ids dense enough to index arrays with.
+    """
+    def __init__(self):
+        self._next: int = 0  # The lowest id that was never handed out.
+        self._free: list[int] = []  # A heap of released ids.
+
+    def __len__(self) -> int:
+        """The number of ids in use."""
+        return self._next - len(self._free)
+
+    def allocate(self) -> int:
+        """Return an id that isn't in use."""
+        if self._free:
+            return heapq.heappop(self._free)
+        self._next += 1
+        return self._next - 1
+
+    def release(self, allocated_id: int):
+        """Free an id, so it can be handed out again."""
+        heapq.heappush(self._free, allocated_id)
+
+
+class PlayerArrays:
+    """A structure-of-arrays store of player state, simulated with vectorized NumPy operations.
+
+    Each player id is a row index into the arrays, so ids should be small and reused, like client ids.
+    The arrays can be the only record of the players, since ``PlayerArrays.as_dicts()`` builds the player
+    dictionaries used in the game state from them when they are needed.
+    """
+    def __init__(self, capacity: int = 64):
+        self.positions = np.zeros((capacity, 2))  # The x and y position of each player.
+        self.velocities = np.zeros((capacity, 2))  # The x and y velocity of each player, in pixels per second.
+        self.keys = np.zeros(capacity, np.uint8)  # The ``Input`` flags each player is holding down.
+        self.seqs = np.zeros(capacity, np.uint32)  # The number of each player's latest movement.
+        self.active = np.zeros(capacity, bool)  # Whether each row holds a player.
+        self.names: list[str] = [""] * capacity
+
+    def __len__(self) -> int:
+        return int(self.active.sum())
+
+    def __contains__(self, player_id: int) -> bool:
+        return player_id < len(self.active) and bool(self.active[player_id])
+
+    def _grow(self, capacity: int):
+        """Grow the arrays to hold at least ``capacity`` players."""
+        size = len(self.active)
+        while size < capacity:
+            size *= 2
+        extra = size - len(self.active)
+        self.positions = np.concatenate((self.positions, np.zeros((extra, 2))))
+        self.velocities = np.concatenate((self.velocities, np.zeros((extra, 2))))
+        self.keys = np.concatenate((self.keys, np.zeros(extra, np.uint8)))
+        self.seqs = np.concatenate((self.seqs, np.zeros(extra, np.uint32)))
+        self.active = np.concatenate((self.active, np.zeros(extra, bool)))
+        self.names.extend([""] * extra)
+
+    def add(self, player_id: int, name: str, position: Iterable[float]):
+        """Add a player standing still at a position."""
+        if player_id >= len(self.active):
+            self._grow(player_id + 1)
+        self.positions[player_id] = position
+        self.velocities[player_id] = 0
+        self.keys[player_id] = 0
+        self.seqs[player_id] = 0
+        self.active[player_id] = True
+        self.names[player_id] = name
+
+    def remove(self, player_id: int):
+        """Remove a player, freeing its row."""
+        self.active[player_id] = False
+        self.keys[player_id] = 0
+        self.velocities[player_id] = 0
+
+    def set_input(self, player_id: int, keys: int, seq: int):
+        """Set the keys a player is holding down, along with the number of their latest movement."""
+        self.keys[player_id] = keys
+        self.seqs[player_id] = seq
+
+    def set_position(self, player_id: int, position: Iterable[float], seq: int):
+        """Set the position of a player, along with the number of their latest movement it includes."""
+        self.positions[player_id] = position
+        self.seqs[player_id] = seq
+
+    def step(self, dt: float) -> "np.ndarray":
+        """Move every player by the keys they are holding down for ``dt`` seconds, wrapping around the screen.
+
+        Returns the ids of the players that moved.
+        """
+        keys = self.keys
+        self.velocities[:, 0] = ((keys & Input.RIGHT) > 0).astype(float) - ((keys & Input.LEFT) > 0)
+        self.velocities[:, 1] = ((keys & Input.DOWN) > 0).astype(float) - ((keys & Input.UP) > 0)
+        self.velocities *= PLAYER_SPEED
+        self.positions += self.velocities * dt
+        self.positions %= SCREEN_SIZE
+        return np.flatnonzero((keys != 0) & self.active)
+
+    def within(self, position: tuple[float, float], radius: float) -> "np.ndarray":
+        """Return the ids of the players within ``radius`` of ``position``."""
+        squared = ((self.positions - position) ** 2).sum(axis=1)
+        return np.flatnonzero((squared <= radius * radius) & self.active)
+
+    def as_dict(self, player_id: int) -> dict:
+        """Return a player as a player dictionary, like the ones in the game state."""
+        return {"name": self.names[player_id], "position": self.positions[player_id].tolist(),
+                "seq": int(self.seqs[player_id])}
+
+    def as_dicts(self) -> dict[int, dict]:
+        """Return every player as player dictionaries by id, like the game state's ``"player_dicts"``."""
+        player_ids = np.flatnonzero(self.active)
+        # Convert whole columns at once, which is much faster than converting each player's values.
+        return {
+            player_id: {"name": self.names[player_id], "position": position, "seq": seq}
+            for player_id, position, seq in zip(
+                player_ids.tolist(), self.positions[player_ids].tolist(), self.seqs[player_ids].tolist()
+            )
+        }
@@ -0,0 +1,49 @@
+from collections import deque
+
+from settings import SCREEN_SIZE, PLAYER_SPEED, Input
+
+
+def input_movement(keys: int, dt: float) -> tuple[float, float]:
+    """Return how far a player holding down the ``Input`` flags in ``keys`` moves in ``dt`` seconds.
+
+    This is the movement rule shared by the clients and the server.
+    """
+    return (
+        (bool(keys & Input.RIGHT) - bool(keys & Input.LEFT)) * PLAYER_SPEED * dt,
+        (bool(keys & Input.DOWN) - bool(keys & Input.UP)) * PLAYER_SPEED * dt,
+    )
+
+
+def apply_movement(position: list[float], movement: tuple[float, float]) -> list[float]:
+    """Return the position moved by ``movement``, wrapping around the screen."""
+    return [(position[0] + movement[0]) % SCREEN_SIZE[0], (position[1] + movement[1]) % SCREEN_SIZE[1]]
+
+
+class Predictor:
+    """Client-side prediction of the local player's movement.
+
+    Every movement is numbered and kept until the server acknowledges it.
+    When the server sends the player's authoritative position along with the number of the last movement it applied,
+    the movements it hasn't applied yet are replayed on top of it,
+    so the player doesn't snap back to where it was a round trip ago.
+    """
+    def __init__(self, size: int = 1024):
+        self.seq: int = 0  # The number of the latest movement.
+        self._movements: deque[tuple[int, tuple[float, float]]] = deque(maxlen=size)  # Unacknowledged movements.
+
+    def record(self, movement: tuple[float, float]) -> int:
+        """Remember a movement the player made, returning its number."""
+        self.seq += 1
+        self._movements.append((self.seq, movement))
+        return self.seq
+
+    def reconcile(self, position: list[float], acked_seq: int) -> list[float]:
+        """Return the predicted position, given the server's position after applying movement ``acked_seq``."""
+        # Forget the movements the server has already applied.
+        while self._movements and self._movements[0][0] <= acked_seq:
+            self._movements.popleft()
+        # Replay the rest.
+        position = list(position)
+        for _, movement in self._movements:
+            position = apply_movement(position, movement)
+        return position
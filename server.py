@@ -1,10 +1,37 @@
+import asyncio
+import socket
+import struct
+import time
 from collections import deque
 
 import anyio
 
+import channel
+import metrics
+import mmsg
+import snapshot
+from settings import Event
+
 # Typing imports.
-from anyio.abc import UDPSocket
-from typing import Any, Optional, Callable
+from anyio.abc import UDPSocket, CancelScope, SocketStream, TaskGroup
+from anyio.streams.memory import MemoryObjectSendStream, MemoryObjectReceiveStream
+from typing import Any, Optional, Callable, Collection, Awaitable
+
+# What decoding a malformed datagram, or handling a packet missing the keys of its event, can raise.
+_MALFORMED_ERRORS = (ValueError, KeyError, IndexError, TypeError, struct.error)
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    """Hands the datagrams received by the transport of the "asyncio" backend to the server."""
+    def __init__(self, server: "_Server"):
+        self.server = server
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]):
+        self.server._datagram_received(data, address)
+
+    def error_received(self, exc: OSError):
+        # Errors like sending to a closed port on Windows don't concern the other clients.
+        pass
 
 
 class _Server:
@@ -17,41 +44,284 @@ class _Server:
         # Public attributes.
         self.encode: Callable[[Any], bytes] = lambda x: x
         self.decode: Callable[[bytes], Any] = lambda x: x
+        # Reads the event of an encoded packet, to count packets by event in the metrics.
+        self.peek: Callable[[bytes], tuple[Any, Optional[int]]] = lambda x: (None, None)
+        self.tick_rate: int = 30  # How many times per second the server ticks.
+        self.overruns: int = 0  # Number of ticks that took longer than one tick period.
+        self.late_ticks: int = 0  # Number of ticks that started noticeably after their deadline.
+        self.tick_time_ns: int = 0  # How long the last tick took to run and encode its packets.
+        self.send_time_ns: int = 0  # How long the last tick's packets took to send.
+        # Whether to send clients deltas of the game state against the last snapshot they acknowledged.
+        self.delta_snapshots: bool = False
+        self.snapshot_history: int = 32  # How many recent snapshots are kept as possible baselines.
+        # When set, called every tick with each client's address to build that client's already encoded
+        # game state packet, instead of broadcasting the game state. This bypasses delta snapshots.
+        self.view_func: Optional[Callable[[tuple[str, int]], bytes]] = None
+        # How the server socket is driven. "anyio" receives and sends one datagram at a time through anyio.
+        # "batch" drains a plain non-blocking socket of many datagrams each time it becomes readable.
+        # "asyncio" uses an asyncio datagram transport, receiving through callbacks and sending without waiting.
+        self.backend: str = "anyio"
+        self.use_uvloop: bool = False  # Whether to run the event loop on uvloop, which must be installed.
+        self.recv_batch_size: int = 256  # The most datagrams the "batch" backend receives per wakeup.
+        # Whether the "batch" backend sends many datagrams per system call with sendmmsg, where it is available.
+        # Off by default, since building the messages in Python costs more than the system calls it saves,
+        # as ``python benchmark.py send`` shows.
+        self.use_sendmmsg: bool = False
+        self.recv_wakeups: int = 0  # Number of times the receive task woke up to receive datagrams.
+        self.recv_datagrams: int = 0  # Number of datagrams received.
+        self.recv_batch_max: int = 0  # The most datagrams received in a single wakeup.
+        # Number of datagrams dropped for being too short for the header, or failing to decode.
+        self.malformed: int = 0
+        # Clients that haven't sent anything for this many seconds are disconnected. None disables timeouts.
+        self.client_timeout: Optional[float] = None
+        # Called with a client's address whenever a client is disconnected, to clean up after it.
+        self.disconnect_func: Callable[[tuple[str, int]], Any] = lambda address: None
+        # Number of clients disconnected for each reason, like "idle" for timeouts and "leave" for leaving.
+        self.evictions: dict[str, int] = {"idle": 0, "leave": 0}
+        # When each address last sent a packet, in monotonic nanoseconds.
+        self.last_seen: dict[tuple[str, int], int] = {}
+        # Whether packets carry a sequence number header, to drop duplicates and count lost and late packets.
+        # Must match ``_Connection.sequence_header`` on the clients.
+        self.sequence_header: bool = False
+        self.peers: dict[tuple[str, int], channel.Peer] = {}  # Sequence numbering of each address.
+        # Events where only the newest packet of a client matters, like movement inputs.
+        # Packets of these events that arrive after a newer packet from the same client are dropped,
+        # so they can't roll back what the newer one did. Needs ``_Server.sequence_header``.
+        self.latest_only: Collection[Any] = ()
+        self.dropped: int = 0  # Number of packets dropped for arriving after newer ones of a ``latest_only`` event.
+        # Seconds between the PING packets sent to every client to measure round trip times.
+        # Clients' pings are only answered while this is set. None disables pings.
+        # Pings need a codec supporting ``settings.Event.PING`` and ``settings.Event.PONG``.
+        self.ping_interval: Optional[float] = None
+        # The measured round trip time to each client that has answered a ping.
+        self.client_stats: dict[tuple[str, int], channel.RoundTrip] = {}
+        # When set, the server records tick phase timings, packet counters and queue depths into it.
+        # None turns the instrumentation off.
+        self.metrics: Optional[metrics.Metrics] = None
+        # When set along with ``_Server.metrics``, the metrics are served in the Prometheus text format
+        # over HTTP on this local TCP port.
+        self.admin_port: Optional[int] = None
 
         # Private internal variables.
         self._socket: Optional[UDPSocket] = None
+        self._raw_socket: Optional[socket.socket] = None  # The socket used by the "batch" backend.
+        self._transport: Optional[asyncio.DatagramTransport] = None  # The transport used by the "asyncio" backend.
+        # Reference to the cancel scope of the task group to allow shutdown.
+        self._cancel_scope: Optional[CancelScope] = None
         self._address: Optional[tuple[str, int]] = None
         self._in_queue: deque[tuple[Any, tuple[str, int]]] = deque()  # Incoming packets.
-        self._out_queue: deque[tuple[tuple[str, int], Any]] = deque()  # Outgoing packets.
-        self.tick_func: Callable = lambda: None  # The main server tick function.
+        # Outgoing packets, with their recipients and whether they are sent reliably.
+        self._out_queue: deque[tuple[Collection[tuple[str, int]], Any, bool]] = deque()
+        # Addresses with reliable messages to send or acknowledge.
+        self._reliable_peers: set[tuple[str, int]] = set()
+        self._next_ping: int = 0  # When to send the next ping, in monotonic nanoseconds.
+        # Pings received from clients to answer, with when they arrived in monotonic nanoseconds.
+        self._pings: list[tuple[tuple[str, int], int, int]] = []
+        # The host of the server when it is a room of a ``_RoomServer``, and the lock its rooms take turns sending with.
+        self._host: Optional["_RoomServer"] = None
+        self._send_lock: Optional[anyio.Lock] = None
+        self.tick_func: Callable[[float], Any] = lambda dt: None  # The main server tick function.
         self.game_state: dict = {}  # The main game state to send to all the clients every tick.
         self.clients: set[tuple[str, int]] = set()  # Keep track of the clients currently connected.
+        self._tick: int = 0  # The number of the current tick, used to number snapshots.
+        self._history: Optional[snapshot.History] = None  # Recent snapshots of the game state.
+        self._acks: dict[tuple[str, int], int] = {}  # The latest snapshot each client acknowledged.
+        # Hand-off of encoded ticks from the tick task to the send task.
+        # Holding one tick while another is being sent double-buffers them.
+        self._frame_send: Optional[MemoryObjectSendStream[list[tuple[Collection[tuple[str, int]], bytes]]]] = None
+        self._frame_receive: Optional[MemoryObjectReceiveStream[list[tuple[Collection[tuple[str, int]], bytes]]]] = None
 
     @property
     def address(self) -> Optional[tuple[str, int]]:
         """The address of the server as a tuple of ``host``, ``port``."""
         return self._address
 
-    async def _sendto(self, address: tuple[str, int], packet: Any):
-        """The internal coroutine in charge of actually sending the packet."""
-        await self._socket.sendto(self.encode(packet), *address)
+    @property
+    def datagrams_per_wakeup(self) -> float:
+        """The average number of datagrams received each time the receive task woke up."""
+        return self.recv_datagrams / self.recv_wakeups if self.recv_wakeups else 0.0
+
+    def use_codec(self, codec: Any):
+        """Encode and decode packets with the ``encode``, ``decode`` and ``peek`` functions of a codec,
+        like ``codec.BINARY``.
+        """
+        self.encode = codec.encode
+        self.decode = codec.decode
+        self.peek = codec.peek
 
-    def sendto(self, address: tuple[str, int], packet: Any):
+    def sendto(self, address: tuple[str, int], packet: Any, reliable: bool = False):
         """Queue a packet to be sent to the given client.
 
         The packet will be encoded with ``_Server.encode(packet)``.
+        A ``reliable`` packet is resent until the client acknowledges it, and delivered in order with
+        the client's other reliable packets. This needs ``_Server.sequence_header``, otherwise it is sent normally.
         """
-        self._out_queue.append((address, packet))
+        self._out_queue.append(((address,), packet, reliable))
 
-    def sendall(self, packet: Any):
-        """Queue a packet to be sent to all the currently registered clients."""
-        for address in self.clients:
-            self._out_queue.append((address, packet))
+    def acknowledge(self, address: tuple[str, int], tick: int):
+        """Record that a client received the game state snapshot of the given tick.
+
+        Only used when ``_Server.delta_snapshots`` is ``True``,
+        in which case the client is sent deltas against the latest snapshot it acknowledged.
+        """
+        if tick > self._acks.get(address, -1):
+            self._acks[address] = tick
+
+    def disconnect(self, address: tuple[str, int], reason: str = "leave"):
+        """Forget a client, so it stops receiving packets, and call ``_Server.disconnect_func`` with its address.
+
+        The disconnection is counted in ``_Server.evictions`` under ``reason``.
+        """
+        self.clients.discard(address)
+        self.evictions[reason] = self.evictions.get(reason, 0) + 1
+        self._forget(address)
+        self.disconnect_func(address)
+
+    def _forget(self, address: tuple[str, int]):
+        """Drop everything kept about an address, and let the host know if this server is a room."""
+        self.last_seen.pop(address, None)
+        self.peers.pop(address, None)
+        self._reliable_peers.discard(address)
+        self.client_stats.pop(address, None)
+        self._acks.pop(address, None)
+        if self._host is not None:
+            self._host._leave(self, address)
+
+    async def _reap_loop(self):
+        """The task responsible for disconnecting clients that stopped sending packets.
+
+        Checks for idle clients a few times per ``_Server.client_timeout``.
+        """
+        while True:
+            await anyio.sleep(self.client_timeout / 4)
+            deadline = time.monotonic_ns() - int(self.client_timeout * 1_000_000_000)
+            for address in [address for address, seen in self.last_seen.items() if seen < deadline]:
+                if address in self.clients:
+                    self.disconnect(address, "idle")
+                else:
+                    # Never joined, so there's nothing to clean up.
+                    self._forget(address)
+
+    def sendall(self, packet: Any, reliable: bool = False):
+        """Queue a packet to be sent to all the currently registered clients.
+
+        The packet is encoded once for all the clients. See ``_Server.sendto`` for ``reliable``.
+        """
+        self._out_queue.append((tuple(self.clients), packet, reliable))
+
+    def _peer(self, address: tuple[str, int]) -> channel.Peer:
+        """Get the sequence numbering of an address, starting it if this is the first packet to or from it."""
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = channel.Peer()
+        return peer
+
+    def _receive(self, data: bytes, address: tuple[str, int]):
+        """Queue a packet received by any of the backends."""
+        if self.sequence_header and len(data) < channel.HEADER.size:
+            # Too short to be one of ours, like a stray datagram from a port scanner.
+            self.malformed += 1
+            return
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter_ns()
+            metrics.count("in", self._datagram_event(data), len(data))
+        self.last_seen[address] = time.monotonic_ns()
+        self.recv_datagrams += 1
+        if self.sequence_header:
+            peer = self._peer(address)
+            status, payloads = peer.accept(data)
+            if peer.needs_ack:
+                self._reliable_peers.add(address)
+            if status == "late" and self.latest_only:
+                payloads = [payload for payload in payloads if not self._superseded(payload)]
+            for payload in payloads:
+                self._deliver(payload, address)
+        else:
+            self._deliver(data, address)
+        if metrics is not None:
+            metrics.phases["recv"].observe(time.perf_counter_ns() - start)
+
+    def _superseded(self, payload: bytes) -> bool:
+        """Whether a late payload is of a ``latest_only`` event, counting it as dropped if it is."""
+        try:
+            event = self.peek(payload)[0]
+        except _MALFORMED_ERRORS:
+            # Left for ``_Server._deliver`` to count as malformed.
+            return False
+        if event in self.latest_only:
+            self.dropped += 1
+            return True
+        return False
+
+    def _deliver(self, data: bytes, address: tuple[str, int]):
+        """Decode and queue a received payload, dropping it and counting it as malformed if that fails."""
+        try:
+            self._queue(self.decode(data), address)
+        except _MALFORMED_ERRORS:
+            self.malformed += 1
+
+    def _datagram_event(self, data: bytes) -> Any:
+        """Read the event of an encoded datagram for the metrics. Datagrams without a payload have no event."""
+        if self.sequence_header:
+            data = data[channel.HEADER.size:]
+        try:
+            return self.peek(data)[0] if data else None
+        except _MALFORMED_ERRORS:
+            # The datagram is dropped once it fails to decode.
+            return None
+
+    def _queue(self, packet: Any, address: tuple[str, int]):
+        """Queue a decoded packet for the tick function, unless it is a ping or a pong handled here."""
+        if self.ping_interval is not None:
+            event = packet["event"]
+            if event == Event.PING:
+                # Answer with the next tick, telling the client how long the ping waited for it.
+                self._pings.append((address, packet["time"], time.monotonic_ns()))
+                return
+            if event == Event.PONG:
+                sample = time.monotonic_ns() - packet["time"] - packet["hold"]
+                self.client_stats.setdefault(address, channel.RoundTrip()).add(sample)
+                if self.metrics is not None:
+                    self.metrics.rtt.observe(sample)
+                return
+        self._in_queue.append((packet, address))
 
     async def _recv_loop(self):
         """The task responsible for receiving packets."""
         async for packet, address in self._socket:
-            self._in_queue.append((self.decode(packet), address))
+            self.recv_wakeups += 1
+            self._receive(packet, address)
+
+    def _datagram_received(self, data: bytes, address: tuple[str, int]):
+        """Receive a packet from the transport of the "asyncio" backend."""
+        self.recv_wakeups += 1
+        self._receive(data, address)
+
+    async def _batch_recv_loop(self):
+        """The task responsible for receiving packets with the "batch" backend.
+
+        Whenever the socket becomes readable, up to ``_Server.recv_batch_size`` datagrams are received
+        into a preallocated buffer without going back to the event loop in between.
+        """
+        buffer = bytearray(65536)  # Big enough for any datagram.
+        view = memoryview(buffer)
+        while True:
+            await anyio.wait_socket_readable(self._raw_socket)
+            received = 0
+            while received < self.recv_batch_size:
+                try:
+                    size, address = self._raw_socket.recvfrom_into(buffer)
+                except BlockingIOError:
+                    # The socket has been drained.
+                    break
+                except ConnectionResetError:
+                    # Windows reports sends to closed ports this way, which doesn't concern receiving.
+                    continue
+                self._receive(bytes(view[:size]), address)
+                received += 1
+            self.recv_wakeups += 1
+            self.recv_batch_max = max(self.recv_batch_max, received)
 
     def __iter__(self):
         return self
@@ -62,40 +332,502 @@ class _Server:
         else:
             raise StopIteration
 
+    def _build_frame(self) -> list[tuple[Collection[tuple[str, int]], bytes]]:
+        """Encode this tick's outgoing packets into a frame of recipients and bytes.
+
+        Each packet is encoded only once, and the same bytes are sent to every recipient.
+        Encoding snapshots the game state, so the next tick can change it while this frame is being sent.
+        """
+        self._tick += 1
+        # Send updated game state to the clients.
+        if self.view_func is not None:
+            frame = [((address,), self.view_func(address)) for address in self.clients]
+        elif self.delta_snapshots:
+            frame = self._build_snapshots()
+        else:
+            frame = [(tuple(self.clients), self.encode(self.game_state))]
+        if self.ping_interval is not None:
+            self._add_pings(frame)
+        # Send client specific events.
+        for addresses, packet, reliable in self._out_queue:
+            data = self.encode(packet)
+            if reliable and self.sequence_header:
+                # Reliable packets are sent when the clients' windows have room for them.
+                for address in addresses:
+                    self._peer(address).queue_reliable(data)
+                    self._reliable_peers.add(address)
+            else:
+                frame.append((addresses, data))
+        # Clear the outgoing queue to prepare for the next tick.
+        self._out_queue.clear()
+        if self.metrics is not None:
+            # Count each packet once for all its recipients, before it is copied for each of them.
+            header_size = channel.HEADER.size if self.sequence_header else 0
+            for addresses, data in frame:
+                self.metrics.count("out", self.peek(data)[0], header_size + len(data), len(addresses))
+        if self.sequence_header:
+            frame = self._stamp_frame(frame)
+        return frame
+
+    def _stamp_frame(self, frame: list[tuple[Collection[tuple[str, int]], bytes]]
+                     ) -> list[tuple[Collection[tuple[str, int]], bytes]]:
+        """Number every packet in a frame with its recipient's next sequence number.
+
+        Every client numbers its packets separately, so each recipient gets its own copy of a packet.
+        Reliable packets that are due to be sent or resent go first.
+        Clients owed an acknowledgement that no other packet carries are sent an empty packet with just the header.
+        """
+        metrics = self.metrics
+        stamped = []
+        for address in list(self._reliable_peers):
+            peer = self.peers.get(address)
+            if peer is None:
+                self._reliable_peers.discard(address)
+                continue
+            for number, data in peer.due():
+                stamped.append(((address,), peer.stamp(data, number)))
+                if metrics is not None:
+                    metrics.count("out", self.peek(data)[0], channel.HEADER.size + len(data))
+        pack = channel.HEADER.pack
+        for addresses, data in frame:
+            for address in addresses:
+                peer = self.peers.get(address) or self._peer(address)
+                stamped.append(((address,), pack(peer.next_seq, peer.reliable_received, 0) + data))
+                peer.next_seq += 1
+                peer.needs_ack = False
+        for address in list(self._reliable_peers):
+            peer = self.peers[address]
+            if peer.needs_ack:
+                stamped.append(((address,), peer.stamp(b"")))
+                if metrics is not None:
+                    metrics.count("out", None, channel.HEADER.size)
+            if not peer.pending:
+                self._reliable_peers.discard(address)
+        return stamped
+
+    def _add_pings(self, frame: list[tuple[Collection[tuple[str, int]], bytes]]):
+        """Add answers to the clients' pings to a frame, and a ping to every client when one is due."""
+        now = time.monotonic_ns()
+        for address, sent, received in self._pings:
+            frame.append(((address,), self.encode({"event": Event.PONG, "time": sent, "hold": now - received})))
+        self._pings.clear()
+        if now >= self._next_ping:
+            self._next_ping = now + int(self.ping_interval * 1_000_000_000)
+            frame.append((tuple(self.clients), self.encode({"event": Event.PING, "time": now})))
+
+    def _build_snapshots(self) -> list[tuple[Collection[tuple[str, int]], bytes]]:
+        """Encode the game state for each client as a delta against the last snapshot it acknowledged.
+
+        Clients without a usable baseline get the full game state as a keyframe.
+        """
+        state = snapshot.copy_state(self.game_state)
+        # Group the clients by baseline, so each distinct packet is only encoded once.
+        groups: dict[Optional[int], list[tuple[str, int]]] = {}
+        for address in self.clients:
+            baseline = self._acks.get(address)
+            groups.setdefault(baseline if baseline in self._history else None, []).append(address)
+        frame = []
+        for baseline, addresses in groups.items():
+            packet = self._history.make_packet(self._tick, state, baseline)
+            frame.append((addresses, self.encode(packet)))
+        self._history.add(self._tick, state)
+        return frame
+
+    async def _send_frame(self, frame: list[tuple[Collection[tuple[str, int]], bytes]]):
+        """Send every packet in a frame to its recipients."""
+        if self._raw_socket is not None:
+            await self._send_frame_raw(frame)
+            return
+        if self._transport is not None:
+            # The transport buffers whatever can't be sent right away, so there's no need to wait.
+            for addresses, data in frame:
+                for address in addresses:
+                    self._transport.sendto(data, address)
+            return
+        for addresses, data in frame:
+            for address in addresses:
+                await self._socket.sendto(data, *address)
+
+    async def _send_frame_raw(self, frame: list[tuple[Collection[tuple[str, int]], bytes]]):
+        """Send every packet in a frame through the non-blocking socket of the "batch" backend.
+
+        Packets are sent without going back to the event loop,
+        unless the socket buffer is full, in which case this waits until it can be written to again.
+        With ``_Server.use_sendmmsg``, the whole frame is sent in as few system calls as possible.
+        """
+        if self.use_sendmmsg and mmsg.AVAILABLE:
+            datagrams = [(data, address) for addresses, data in frame for address in addresses]
+            sent = 0
+            while sent < len(datagrams):
+                try:
+                    sent += mmsg.sendmmsg(self._raw_socket, datagrams[sent:sent + mmsg.MAX_BATCH])
+                except BlockingIOError:
+                    await anyio.wait_socket_writable(self._raw_socket)
+            return
+        for addresses, data in frame:
+            for address in addresses:
+                while True:
+                    try:
+                        self._raw_socket.sendto(data, address)
+                        break
+                    except BlockingIOError:
+                        await anyio.wait_socket_writable(self._raw_socket)
+
+    async def _send_loop(self):
+        """The task responsible for sending out the frames built by the tick task."""
+        async for frame in self._frame_receive:
+            if self._send_lock is not None:
+                # Rooms sharing a socket take turns, since the anyio backend can't send for two tasks at once.
+                await self._send_lock.acquire()
+            try:
+                start = time.perf_counter_ns()
+                await self._send_frame(frame)
+                self.send_time_ns = time.perf_counter_ns() - start
+            finally:
+                if self._send_lock is not None:
+                    self._send_lock.release()
+            if self.metrics is not None:
+                self.metrics.phases["send"].observe(self.send_time_ns)
+
+    def _measured_tick(self, dt: float) -> list[tuple[Collection[tuple[str, int]], bytes]]:
+        """Call the tick function and build the frame, recording their timings and queue depths in the metrics."""
+        self.metrics.in_queue_depth = len(self._in_queue)
+        start = time.perf_counter_ns()
+        self.tick_func(dt)
+        encode_start = time.perf_counter_ns()
+        self.metrics.out_queue_depth = len(self._out_queue)
+        frame = self._build_frame()
+        self.metrics.phases["tick"].observe(encode_start - start)
+        self.metrics.phases["encode"].observe(time.perf_counter_ns() - encode_start)
+        return frame
+
+    def metrics_text(self) -> str:
+        """Render ``_Server.metrics`` and the server's own counters in the Prometheus text format."""
+        return self.metrics.render({
+            "game_clients": ("gauge", "Clients currently connected.", len(self.clients)),
+            "game_tick_rate": ("gauge", "Ticks per second the server aims for.", self.tick_rate),
+            "game_tick_overruns_total": ("counter", "Ticks that took longer than one tick period.", self.overruns),
+            "game_late_ticks_total": ("counter", "Ticks that started noticeably late.", self.late_ticks),
+            "game_recv_wakeups_total": ("counter", "Times the receive task woke up.", self.recv_wakeups),
+            "game_malformed_packets_total": ("counter", "Datagrams dropped for failing to decode.", self.malformed),
+            "game_late_packets_dropped_total": ("counter", "Packets dropped for arriving after newer ones.",
+                                                self.dropped),
+            "game_evictions_total": ("counter", "Clients disconnected.", sum(self.evictions.values())),
+            "game_retransmits_total": ("counter", "Reliable packets resent.",
+                                       sum(peer.retransmits for peer in self.peers.values())),
+        })
+
+    async def _serve_admin(self, stream: SocketStream):
+        """Answer a request on the admin port with the metrics, as a minimal HTTP response."""
+        async with stream:
+            try:
+                # Read the request, whatever it is, but don't wait on tools that send nothing.
+                with anyio.move_on_after(1):
+                    await stream.receive()
+                body = self.metrics_text().encode()
+                await stream.send(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                                  b"Content-Length: %d\r\n\r\n%b" % (len(body), body))
+            except (anyio.EndOfStream, anyio.BrokenResourceError):
+                # The other end went away, which doesn't concern the game.
+                pass
+
+    async def _admin_loop(self):
+        """The task responsible for serving the metrics on the admin port."""
+        listener = await anyio.create_tcp_listener(local_host="127.0.0.1", local_port=self.admin_port)
+        await listener.serve(self._serve_admin)
+
     async def _server_tick(self):
-        """The task responsible for ticking the server and sending out packets to the clients."""
+        """The task responsible for ticking the server and sending out packets to the clients.
+
+        Ticks are scheduled ``1 / tick_rate`` seconds apart on a monotonic nanosecond clock.
+        Each deadline is computed from the previous deadline, not from when the last tick finished,
+        so the time spent ticking and sending doesn't accumulate into drift.
+        ``tick_func`` is called with the time in seconds since the previous tick.
+
+        Sending is left to the send task, so the next tick can run while this tick's packets go out.
+        """
+        period = 1_000_000_000 // self.tick_rate
+        # Ticks waking up later than this after their deadline are counted as late.
+        late_threshold = period // 10
+        last_tick = deadline = time.monotonic_ns()
         while True:
             # Do one server tick.
-            self.tick_func()
-            await anyio.sleep(0)
-            # Send updated game state to the clients.
-            for address in self.clients:
-                await self._sendto(address, self.game_state)
-            # Send client specific events.
-            for address, packet in self._out_queue:
-                await self._sendto(address, packet)
-            # Clear the outgoing queue to prepare for the next tick.
-            self._out_queue.clear()
+            now = time.monotonic_ns()
+            if self.metrics is None:
+                self.tick_func((now - last_tick) / 1_000_000_000)
+                frame = self._build_frame()
+            else:
+                frame = self._measured_tick((now - last_tick) / 1_000_000_000)
+            last_tick = now
+            self.tick_time_ns = time.monotonic_ns() - now
+            # Hand the frame over to the send task.
+            # This only waits if the send task is still busy with the two previous ticks.
+            await self._frame_send.send(frame)
+            # Wait for the next tick deadline.
+            deadline += period
+            now = time.monotonic_ns()
+            if now >= deadline:
+                # The tick ran past the next deadline, so skip the missed deadlines
+                # instead of running a burst of catch-up ticks.
+                self.overruns += 1
+                deadline = now
+                # Still yield to other tasks so packets can be received.
+                await anyio.sleep(0)
+            else:
+                await anyio.sleep((deadline - now) / 1_000_000_000)
+                if time.monotonic_ns() - deadline > late_threshold:
+                    self.late_ticks += 1
+
+    async def _run_tasks(self):
+        """Run the tasks ticking the server and sending its packets, which don't depend on the socket's backend."""
+        self._history = snapshot.History(self.snapshot_history)
+        # One frame can wait in the hand-off while another is being sent.
+        self._frame_send, self._frame_receive = anyio.create_memory_object_stream(1)
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(self._send_loop, name="Send Loop")  # noqa
+            tg.start_soon(self._server_tick, name="Server Tick")  # noqa
+            if self.client_timeout is not None:
+                tg.start_soon(self._reap_loop, name="Reap Loop")  # noqa
 
     def run(self, host: str, port: int, tick_func: Callable):
         """Start the server on the given network address and use ``tick_func`` as a server tick.
 
-        This function blocks until an error is thrown.
+        ``tick_func`` is called ``_Server.tick_rate`` times per second with the delta time in seconds.
+        The socket is driven by the backend named by ``_Server.backend``.
+
+        This function blocks until an error is thrown or ``_Server.shutdown()`` is called.
         To manually shut down the server from outside, use a keyboard interrupt with ^C.
         """
+        async def serve(recv_loop: Optional[Callable[[], Awaitable]]):
+            # Assign internal variables.
+            self._address = host, port
+            self.tick_func = tick_func
+            async with anyio.create_task_group() as tg:
+                # Keep track of the cancel scope for easy shutdown later.
+                self._cancel_scope = tg.cancel_scope
+                # Run all of these tasks in parallel.
+                if recv_loop is not None:
+                    tg.start_soon(recv_loop, name="Receive Loop")  # noqa
+                tg.start_soon(self._run_tasks, name="Server Tasks")  # noqa
+                if self.metrics is not None and self.admin_port is not None:
+                    tg.start_soon(self._admin_loop, name="Admin Loop")  # noqa
+
         async def main():
             # Create the server socket.
-            async with await anyio.create_udp_socket(local_host=host, local_port=port) as socket:
-                # Assign internal variables.
-                self._socket = socket
-                self._address = host, port
-                self.tick_func = tick_func
-                async with anyio.create_task_group() as tg:
-                    # Run all of these tasks in parallel.
-                    tg.start_soon(self._recv_loop, name="Receive Loop")  # noqa
-                    tg.start_soon(self._server_tick, name="Server Tick")  # noqa
+            if self.backend == "batch":
+                family = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0][0]
+                with socket.socket(family, socket.SOCK_DGRAM) as raw_socket:
+                    raw_socket.setblocking(False)
+                    raw_socket.bind((host, port))
+                    self._raw_socket = raw_socket
+                    await serve(self._batch_recv_loop)
+                self._raw_socket = None
+            elif self.backend == "asyncio":
+                # Received datagrams are handed straight to the server by the protocol's callback.
+                self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                    lambda: _ServerProtocol(self), local_addr=(host, port))
+                try:
+                    await serve(None)
+                finally:
+                    self._transport.close()
+                    self._transport = None
+            else:
+                async with await anyio.create_udp_socket(local_host=host, local_port=port) as udp_socket:
+                    self._socket = udp_socket
+                    await serve(self._recv_loop)
+                self._socket = None
         # Enter the async loop.
-        anyio.run(main)  # noqa
+        anyio.run(main, backend_options={"use_uvloop": self.use_uvloop})  # noqa
+
+    def shutdown(self):
+        """Terminate the network processes and cause ``_Server.run`` to return.
+
+        This function does nothing if the server isn't running.
+        """
+        if self._cancel_scope:
+            self._cancel_scope.cancel()
+            self._cancel_scope = None
+
+    @property
+    def running(self) -> bool:
+        """Whether the server is running."""
+        return self._cancel_scope is not None
+
+
+class _RoomServer(_Server):
+    """Hosts many rooms behind one socket, each a ``_Server`` with its own game state, clients and tick schedule.
+
+    Rooms are added with ``_RoomServer.add_room(room)``, before or while running, and are given their tick function
+    through ``_Server.tick_func`` instead of ``_Server.run``. They use the host's socket, codec and
+    ``sequence_header``, while settings like ``tick_rate`` and ``client_timeout`` are their own.
+
+    Packets are routed to rooms by the address they come from, which identifies a client's session.
+    The first packet from an address that isn't in a room is decoded and passed to
+    ``_RoomServer.room_func(packet, address)``, which returns the room to put it in, or ``None`` to drop the packet.
+    Once a room forgets an address, like when it disconnects the client, the address's next packet is placed again.
+    """
+    def __init__(self):
+        super().__init__()
+        # Public attributes.
+        self.rooms: list[_Server] = []  # The rooms being hosted.
+        self.room_func: Callable[[Any, tuple[str, int]], Optional[_Server]] = self.fill_rooms
+        # Creates a new room for ``_RoomServer.fill_rooms`` when all rooms are full. None only uses the rooms added.
+        self.room_factory: Optional[Callable[[], _Server]] = None
+        self.room_size: int = 8  # The most addresses ``_RoomServer.fill_rooms`` puts in one room.
+        self.strays: int = 0  # Number of packets dropped for coming from an address no room took.
+
+        # Private variables.
+        self._room_of: dict[tuple[str, int], _Server] = {}  # The room of each address.
+        self._opened: set[_Server] = set()  # Rooms opened by ``_RoomServer.fill_rooms``, closed once empty.
+        self._task_group: Optional[TaskGroup] = None  # The task group running the rooms.
+
+    def add_room(self, room: _Server) -> _Server:
+        """Host a room, and start running it if the host is running.
+
+        The room is given the host's codec, ``sequence_header`` and ``latest_only``. Returns the room.
+        """
+        room._host = self
+        room.encode, room.decode, room.peek = self.encode, self.decode, self.peek
+        room.sequence_header = self.sequence_header
+        room.latest_only = self.latest_only
+        if room.metrics is None:
+            # Record into the host's metrics, so the admin port covers every room.
+            room.metrics = self.metrics
+        self.rooms.append(room)
+        if self._task_group is not None:
+            self._task_group.start_soon(self._run_room, room, name="Room")  # noqa
+        return room
+
+    def close_room(self, room: _Server):
+        """Stop hosting a room. Its addresses are placed in a room again when they send another packet."""
+        if room not in self.rooms:
+            return
+        self.rooms.remove(room)
+        self._opened.discard(room)
+        for address in [address for address, other in self._room_of.items() if other is room]:
+            del self._room_of[address]
+        # Keep the room's counts, so the host's metrics don't go backwards.
+        self.overruns += room.overruns
+        self.late_ticks += room.late_ticks
+        self.malformed += room.malformed
+        self.dropped += room.dropped
+        for reason, count in room.evictions.items():
+            self.evictions[reason] = self.evictions.get(reason, 0) + count
+        room._host = None
+        room.shutdown()
+
+    def fill_rooms(self, packet: Any, address: tuple[str, int]) -> Optional[_Server]:
+        """The default ``room_func``: put joining clients in the first room with fewer than ``room_size`` addresses.
+
+        When every room is full, a new room is opened with ``_RoomServer.room_factory``, which closes once empty.
+        """
+        if packet["event"] != Event.JOIN:
+            return None
+        for room in self.rooms:
+            if len(room.last_seen) < self.room_size:
+                return room
+        if self.room_factory is None:
+            return None
+        room = self.add_room(self.room_factory())
+        self._opened.add(room)
+        return room
+
+    def _receive(self, data: bytes, address: tuple[str, int]):
+        """Route a packet received by any of the backends to the room of its address."""
+        self.recv_datagrams += 1
+        room = self._room_of.get(address)
+        if room is None:
+            room = self._place(data, address)
+            if room is None:
+                return
+        room._receive(data, address)
+
+    def _place(self, data: bytes, address: tuple[str, int]) -> Optional[_Server]:
+        """Put an address in the room ``_RoomServer.room_func`` picks for its packet.
+
+        Returns ``None`` if no room took it, counting the packet as a stray or as malformed.
+        """
+        if self.sequence_header and len(data) < channel.HEADER.size:
+            self.malformed += 1
+            return None
+        payload = data[channel.HEADER.size:] if self.sequence_header else data
+        if not payload:
+            # Only an acknowledgement, which says nothing about where it belongs.
+            self.strays += 1
+            return None
+        try:
+            room = self.room_func(self.decode(payload), address)
+        except _MALFORMED_ERRORS:
+            self.malformed += 1
+            return None
+        if room is None:
+            self.strays += 1
+        else:
+            self._room_of[address] = room
+        return room
+
+    def _leave(self, room: _Server, address: tuple[str, int]):
+        """Take an address out of a room that forgot it, closing the room if ``fill_rooms`` opened it and it's empty."""
+        if self._room_of.get(address) is room:
+            del self._room_of[address]
+        if room in self._opened and not room.last_seen:
+            self.close_room(room)
+
+    async def _run_room(self, room: _Server):
+        """Run a room's tasks on the host's socket until it is closed or shuts itself down."""
+        if room not in self.rooms:
+            # Closed before it got to start.
+            return
+        room._address = self._address
+        room._socket, room._raw_socket, room._transport = self._socket, self._raw_socket, self._transport
+        room._send_lock = self._send_lock
+        with anyio.CancelScope() as scope:
+            room._cancel_scope = scope
+            await room._run_tasks()
+        self.close_room(room)
+
+    async def _run_tasks(self):
+        """Run every room, including the ones added later, until shut down."""
+        self._send_lock = anyio.Lock()
+        try:
+            async with anyio.create_task_group() as tg:
+                self._task_group = tg
+                for room in self.rooms:
+                    tg.start_soon(self._run_room, room, name="Room")  # noqa
+                await anyio.sleep_forever()
+        finally:
+            self._task_group = None
+            self._send_lock = None
+
+    def metrics_text(self) -> str:
+        """Render ``_Server.metrics``, which the rooms record into as well, and the counters of every room."""
+        rooms = self.rooms
+        return self.metrics.render({
+            "game_rooms": ("gauge", "Rooms currently hosted.", len(rooms)),
+            "game_clients": ("gauge", "Clients currently connected.", sum(len(room.clients) for room in rooms)),
+            "game_tick_overruns_total": ("counter", "Ticks that took longer than one tick period.",
+                                         self.overruns + sum(room.overruns for room in rooms)),
+            "game_late_ticks_total": ("counter", "Ticks that started noticeably late.",
+                                      self.late_ticks + sum(room.late_ticks for room in rooms)),
+            "game_recv_wakeups_total": ("counter", "Times the receive task woke up.", self.recv_wakeups),
+            "game_stray_packets_total": ("counter", "Packets dropped for coming from an address no room took.",
+                                         self.strays),
+            "game_malformed_packets_total": ("counter", "Datagrams dropped for failing to decode.",
+                                             self.malformed + sum(room.malformed for room in rooms)),
+            "game_late_packets_dropped_total": ("counter", "Packets dropped for arriving after newer ones.",
+                                                self.dropped + sum(room.dropped for room in rooms)),
+            "game_evictions_total": ("counter", "Clients disconnected.", sum(self.evictions.values()) + sum(
+                sum(room.evictions.values()) for room in rooms)),
+            "game_retransmits_total": ("counter", "Reliable packets resent.",
+                                       sum(peer.retransmits for room in rooms for peer in room.peers.values())),
+        })
+
+    def run(self, host: str, port: int, tick_func: Optional[Callable] = None):
+        """Start hosting the rooms on the given network address, like ``_Server.run``.
+
+        The rooms tick on their own, so ``tick_func`` isn't needed.
+        """
+        super().run(host, port, tick_func or self.tick_func)
 
 
 # Grant outside access to the server.
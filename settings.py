@@ -1,11 +1,25 @@
-from enum import IntEnum, auto
+from enum import IntEnum, IntFlag, auto
 
 __all__ = (
     "HOST",
     "PORT",
     "SCREEN_SIZE",
+    "TICK_RATE",
+    "SNAPSHOT_HISTORY",
+    "CODEC",
+    "INTERPOLATION_DELAY",
+    "INTEREST_RADIUS",
+    "INTEREST_CELL_SIZE",
+    "SERVER_BACKEND",
+    "CLIENT_TIMEOUT",
+    "SEQUENCE_HEADER",
+    "PING_INTERVAL",
+    "ADMIN_PORT",
     "Event",
+    "Input",
+    "AUTHORITATIVE_MOVEMENT",
     "PLAYER_RADIUS",
+    "PLAYER_SPEED",
     "INITIAL_GAME_STATE",
 )
 
@@ -16,7 +30,46 @@ PORT = 12345
 
 SCREEN_SIZE = (800, 600)
 
+# How many times per second the server ticks and sends out the game state.
+TICK_RATE = 30
+
+# How many recent game state snapshots are kept around as baselines for delta compression.
+SNAPSHOT_HISTORY = 32
+
+# The name of the codec from codec.CODECS used to send packets, either "json" or "binary".
+CODEC = "binary"
+
+# How many seconds in the past clients render other players, interpolating between game states.
+# This should cover a couple of server ticks plus network jitter.
+INTERPOLATION_DELAY = 0.1
+
+# Players only receive the other players within roughly this distance of them.
+# Set to None to send every player the whole world.
+INTEREST_RADIUS = None
+# The size of the grid cells players are bucketed into for interest management.
+INTEREST_CELL_SIZE = 100
+
+# How the server drives its socket, see _Server.backend.
+SERVER_BACKEND = "anyio"
+
+# Clients that haven't sent anything for this many seconds are disconnected by the server.
+CLIENT_TIMEOUT = 10
+
+# Whether packets are numbered, so duplicates and out of order game states can be dropped.
+SEQUENCE_HEADER = True
+
+# Seconds between the pings the server and clients send each other to measure round trip times.
+PING_INTERVAL = 1
+
+# When set, the server records metrics and serves them in the Prometheus text format on this local TCP port.
+ADMIN_PORT = None
+
 PLAYER_RADIUS = 20
+# How fast players move in pixels per second.
+PLAYER_SPEED = 100
+# Whether clients send the keys they are pressing and the server moves the players,
+# instead of clients moving themselves and sending their positions.
+AUTHORITATIVE_MOVEMENT = True
 
 
 # This enumeration keeps track of all the different event types that can be sent back and forth.
@@ -25,6 +78,19 @@ class Event(IntEnum):
     JOINED = auto()
     UPDATE = auto()
     MOVE = auto()
+    ACK = auto()
+    INPUT = auto()
+    LEAVE = auto()
+    PING = auto()
+    PONG = auto()
+
+
+# These flags are the movement keys a player can hold down, sent as a bitmask with INPUT events.
+class Input(IntFlag):
+    RIGHT = auto()
+    LEFT = auto()
+    UP = auto()
+    DOWN = auto()
 
 
 # The game state held by the server as the source of truth.
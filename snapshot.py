@@ -0,0 +1,121 @@
+# Typing imports.
+from typing import Optional
+
+# Delta compression of game state snapshots.
+# A delta only holds the values that changed between a baseline snapshot and a newer one.
+# Nested dictionaries are compared key by key, and keys missing from the newer snapshot are set to ``None``.
+
+
+def diff(baseline: dict, state: dict) -> dict:
+    """Return the delta that turns ``baseline`` into ``state`` when passed to ``patch``."""
+    delta = {}
+    for key, value in state.items():
+        if key not in baseline:
+            # This key is new, so it's sent in full.
+            delta[key] = value
+        elif isinstance(value, dict) and isinstance(baseline[key], dict):
+            # Only send the parts of nested dictionaries that changed.
+            nested = diff(baseline[key], value)
+            if nested:
+                delta[key] = nested
+        elif value != baseline[key]:
+            delta[key] = value
+    # Mark removed keys.
+    for key in baseline:
+        if key not in state:
+            delta[key] = None
+    return delta
+
+
+def patch(baseline: dict, delta: dict) -> dict:
+    """Apply a delta made by ``diff`` to a baseline, returning the new state.
+
+    The baseline isn't modified, and unchanged nested dictionaries are shared with it.
+    """
+    state = dict(baseline)
+    for key, value in delta.items():
+        if value is None:
+            state.pop(key, None)
+        elif isinstance(value, dict) and isinstance(state.get(key), dict):
+            state[key] = patch(state[key], value)
+        else:
+            state[key] = value
+    return state
+
+
+def copy_state(state: dict) -> dict:
+    """Copy a game state, so it can be kept as a snapshot while the original keeps changing.
+
+    Only the dictionaries are copied, other values are shared with the original.
+    So values in a game state, like positions, must be replaced rather than modified in place.
+    """
+    copied = dict(state)
+    for key, value in state.items():
+        if isinstance(value, dict):
+            copied[key] = copy_state(value)
+    return copied
+
+
+class History:
+    """A ring buffer of the most recent snapshots, looked up by their tick number.
+
+    The server uses it to remember the baselines clients may acknowledge,
+    and clients use it to remember the baselines the server may send deltas against.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._snapshots: dict[int, dict] = {}  # Snapshots by tick, from oldest to newest.
+
+    def __contains__(self, tick: Optional[int]) -> bool:
+        return tick in self._snapshots
+
+    def get(self, tick: Optional[int]) -> Optional[dict]:
+        """Return the snapshot for the tick, or ``None`` if it isn't in the buffer."""
+        return self._snapshots.get(tick)
+
+    def add(self, tick: int, state: dict):
+        """Store a snapshot, evicting the oldest one if the buffer is full."""
+        self._snapshots[tick] = state
+        if len(self._snapshots) > self.size:
+            del self._snapshots[next(iter(self._snapshots))]
+
+    def make_packet(self, tick: int, state: dict, baseline: Optional[int]) -> dict:
+        """Build the packet sending the snapshot for ``tick`` to a client that acknowledged ``baseline``.
+
+        If the baseline isn't in the buffer, the packet holds the full state as a keyframe.
+        Otherwise, it is a delta against the baseline.
+        Top-level values that aren't dictionaries, such as event markers, are always included.
+        The packet has ``"tick"`` and ``"baseline"`` keys added, which clients must acknowledge and apply.
+        """
+        if baseline in self:
+            packet = diff(self.get(baseline), state)
+            for key, value in state.items():
+                if not isinstance(value, dict):
+                    packet[key] = value
+        else:
+            packet = dict(state)
+            baseline = None
+        packet["tick"] = tick
+        packet["baseline"] = baseline
+        return packet
+
+    def receive(self, packet: dict) -> Optional[dict]:
+        """Rebuild and store the full state sent in a packet made by ``History.make_packet``.
+
+        Returns ``None`` if the packet is a delta against a baseline that isn't in the buffer.
+        Packets without a tick number are returned as is.
+        """
+        if "tick" not in packet:
+            return packet
+        packet = dict(packet)
+        tick = packet.pop("tick")
+        baseline = packet.pop("baseline")
+        if baseline is None:
+            state = packet
+        elif baseline in self:
+            state = patch(self.get(baseline), packet)
+        else:
+            return None
+        self.add(tick, state)
+        return state
+
@@ -0,0 +1,194 @@
+import math
+
+# Typing imports.
+from typing import Hashable, Iterator, Optional
+
+
+class Grid:
+    """A uniform grid of square cells, bucketing keys by their position.
+
+    Keeping track of which cell each key is in allows finding nearby keys without checking every key.
+    The grid is unbounded, so positions can be anywhere in the world.
+    Queries are fastest when the cell size is close to the usual query radius.
+
+    If ``wrap`` is given, it is the width and height of a world that wraps around at its edges,
+    with positions from 0 up to its size. Keys near opposite edges are then near each other.
+    """
+    def __init__(self, cell_size: float, wrap: Optional[tuple[float, float]] = None):
+        self.cell_size = cell_size
+        self.wrap = wrap
+        if wrap is None:
+            self._columns: Optional[int] = None
+            self._rows: Optional[int] = None
+            self._cell_width: float = cell_size
+            self._cell_height: float = cell_size
+        else:
+            # Fit a whole number of cells in the world, as close to the cell size as possible,
+            # so the cells on opposite edges are neighbours.
+            self._columns = max(1, round(wrap[0] / cell_size))
+            self._rows = max(1, round(wrap[1] / cell_size))
+            self._cell_width = wrap[0] / self._columns
+            self._cell_height = wrap[1] / self._rows
+        # The cells around each cell for ``Grid.cells_near``, by cell and radius, which are only kept when wrapping,
+        # as there is a limited number of cells then.
+        self._neighbourhoods: dict[tuple[tuple[int, int], float], list[tuple[int, int]]] = {}
+        self.cells: dict[tuple[int, int], set[Hashable]] = {}  # The keys in each non-empty cell.
+        self.positions: dict[Hashable, tuple[float, float]] = {}  # The position of each key.
+        self._key_cells: dict[Hashable, tuple[int, int]] = {}  # The cell each key is in.
+        # Bounds of every cell that has ever held a key, which limit how far nearest neighbour searches go.
+        self._bounds: Optional[tuple[int, int, int, int]] = None
+
+    def __len__(self) -> int:
+        return len(self._key_cells)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._key_cells
+
+    def cell(self, position: tuple[float, float]) -> tuple[int, int]:
+        """The coordinates of the cell containing the position."""
+        x, y = int(position[0] // self._cell_width), int(position[1] // self._cell_height)
+        if self.wrap is not None:
+            return x % self._columns, y % self._rows
+        return x, y
+
+    def move(self, key: Hashable, position: tuple[float, float]):
+        """Place a key at a position, adding it to the grid if it isn't in it yet."""
+        self.positions[key] = position
+        cell = self.cell(position)
+        old_cell = self._key_cells.get(key)
+        if cell == old_cell:
+            return
+        if old_cell is not None:
+            self._discard(key, old_cell)
+        self._key_cells[key] = cell
+        self.cells.setdefault(cell, set()).add(key)
+        # Grow the bounds to include the cell.
+        if self._bounds is None:
+            self._bounds = cell[0], cell[1], cell[0], cell[1]
+        else:
+            min_x, min_y, max_x, max_y = self._bounds
+            self._bounds = min(min_x, cell[0]), min(min_y, cell[1]), max(max_x, cell[0]), max(max_y, cell[1])
+
+    def remove(self, key: Hashable):
+        """Remove a key from the grid. Does nothing if the key isn't in it."""
+        cell = self._key_cells.pop(key, None)
+        if cell is not None:
+            del self.positions[key]
+            self._discard(key, cell)
+
+    def _discard(self, key: Hashable, cell: tuple[int, int]):
+        """Take a key out of a cell, dropping the cell once it's empty."""
+        keys = self.cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self.cells[cell]
+
+    def cells_within(self, position: tuple[float, float], radius: float) -> Iterator[tuple[int, int]]:
+        """Yield the non-empty cells overlapping the square around a circle of ``radius`` at ``position``."""
+        for cell in self._rectangle(int((position[0] - radius) // self._cell_width),
+                                    int((position[1] - radius) // self._cell_height),
+                                    int((position[0] + radius) // self._cell_width),
+                                    int((position[1] + radius) // self._cell_height)):
+            if cell in self.cells:
+                yield cell
+
+    def cells_near(self, cell: tuple[int, int], radius: float) -> list[tuple[int, int]]:
+        """Return the non-empty cells overlapping a circle of ``radius`` around any position in ``cell``.
+
+        Unlike ``Grid.cells_within``, the cells only depend on the cell, not on where in it the position is.
+        """
+        neighbourhood = self._neighbourhoods.get((cell, radius))
+        if neighbourhood is None:
+            reach_x = math.ceil(radius / self._cell_width)
+            reach_y = math.ceil(radius / self._cell_height)
+            # Leave out the corners of the square that are too far from every position in the cell.
+            offsets = [(x, y) for x in range(-reach_x, reach_x + 1) for y in range(-reach_y, reach_y + 1)
+                       if math.hypot(max(abs(x) - 1, 0) * self._cell_width,
+                                     max(abs(y) - 1, 0) * self._cell_height) <= radius]
+            if self.wrap is None:
+                neighbourhood = [(cell[0] + x, cell[1] + y) for x, y in offsets]
+            else:
+                # Each cell is only included once, even when the neighbourhood is bigger than the world.
+                neighbourhood = list(dict.fromkeys(((cell[0] + x) % self._columns, (cell[1] + y) % self._rows)
+                                                   for x, y in offsets))
+                self._neighbourhoods[cell, radius] = neighbourhood
+        cells = self.cells
+        return [cell for cell in neighbourhood if cell in cells]
+
+    def _rectangle(self, min_x: int, min_y: int, max_x: int, max_y: int) -> list[tuple[int, int]]:
+        """Return the cells in a rectangle of cell coordinates, which wraps around a wrapping world."""
+        xs = range(min_x, max_x + 1)
+        ys = range(min_y, max_y + 1)
+        if self.wrap is not None:
+            # Each cell is only included once, even when the rectangle is bigger than the world.
+            xs = range(self._columns) if len(xs) >= self._columns else [x % self._columns for x in xs]
+            ys = range(self._rows) if len(ys) >= self._rows else [y % self._rows for y in ys]
+        return [(x, y) for x in xs for y in ys]
+
+    def query_radius(self, position: tuple[float, float], radius: float) -> list[Hashable]:
+        """Return the keys within ``radius`` of ``position``."""
+        x, y = position
+        width, height = self.wrap or (math.inf, math.inf)
+        radius_squared = radius * radius
+        found = []
+        for cell in self.cells_within(position, radius):
+            for key in self.cells[cell]:
+                key_x, key_y = self.positions[key]
+                # Measure the shorter way around a wrapping world.
+                offset_x = abs(key_x - x) % width
+                offset_y = abs(key_y - y) % height
+                if min(offset_x, width - offset_x) ** 2 + min(offset_y, height - offset_y) ** 2 <= radius_squared:
+                    found.append(key)
+        return found
+
+    def nearest(self, position: tuple[float, float], exclude: Optional[Hashable] = None) -> Optional[Hashable]:
+        """Return the key closest to ``position``, or ``None`` if the grid holds no other keys.
+
+        The key ``exclude`` is skipped, which allows finding the nearest neighbour of a key.
+        """
+        if self._bounds is None:
+            return None
+        x, y = position
+        width, height = self.wrap or (math.inf, math.inf)
+        center_x, center_y = self.cell(position)
+        if self.wrap is None:
+            min_x, min_y, max_x, max_y = self._bounds
+            # The furthest ring of cells around the center that can hold any keys.
+            max_ring = max(center_x - min_x, max_x - center_x, center_y - min_y, max_y - center_y)
+        else:
+            # Every cell is within half the world of the center, one way around or the other.
+            max_ring = max(self._columns, self._rows) // 2 + 1
+        best_key = None
+        best_distance = math.inf
+        # Search rings of cells outwards from the cell containing the position.
+        for ring in range(max_ring + 1):
+            for cell in self._ring(center_x, center_y, ring):
+                if self.wrap is not None:
+                    cell = cell[0] % self._columns, cell[1] % self._rows
+                for key in self.cells.get(cell, ()):
+                    if key == exclude:
+                        continue
+                    key_x, key_y = self.positions[key]
+                    offset_x = abs(key_x - x) % width
+                    offset_y = abs(key_y - y) % height
+                    distance = math.hypot(min(offset_x, width - offset_x), min(offset_y, height - offset_y))
+                    if distance < best_distance:
+                        best_key = key
+                        best_distance = distance
+            # Keys in further rings are at least this far away, so nothing closer can be found.
+            if best_distance <= ring * min(self._cell_width, self._cell_height):
+                break
+        return best_key
+
+    @staticmethod
+    def _ring(center_x: int, center_y: int, ring: int) -> Iterator[tuple[int, int]]:
+        """Yield the cells forming the square ring ``ring`` cells away from a center cell."""
+        if ring == 0:
+            yield center_x, center_y
+            return
+        for x in range(center_x - ring, center_x + ring + 1):
+            yield x, center_y - ring
+            yield x, center_y + ring
+        for y in range(center_y - ring + 1, center_y + ring):
+            yield center_x - ring, y
+            yield center_x + ring, y